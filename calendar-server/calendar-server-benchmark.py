@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+#
+# Offline benchmark for cinnamon-calendar-server.
+#
+# Feeds ICalGLib components parsed from a local ICS file (or a generated one)
+# through the server's event processing paths - handle_new_or_modified_objects,
+# the recurrence worker and handle_removed_objects - without needing Evolution
+# Data Server or a session bus.
+#
+# Run from a build tree (or with GI_TYPELIB_PATH pointing at Cinnamon's
+# typelib):
+#
+#   ./calendar-server-benchmark.py --events 5000 --recurring 0.25 --timezones 30
+#   ./calendar-server-benchmark.py --ics ~/exported.ics --since 2026-01-01
+#
+
+import os
+import sys
+import argparse
+import importlib.util
+import random
+import resource
+import time
+
+import gi
+gi.require_version('ECal', '2.0')
+gi.require_version('ICalGLib', '3.0')
+from gi.repository import GLib, Gio
+from gi.repository import ECal, ICalGLib
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cinnamon-calendar-server.py")
+
+spec = importlib.util.spec_from_file_location("calendar_server", SERVER_PATH)
+calendar_server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(calendar_server)
+
+TIMEZONES = [
+    "America/New_York", "America/Chicago", "America/Denver", "America/Los_Angeles",
+    "America/Sao_Paulo", "America/Mexico_City", "America/Toronto", "America/Anchorage",
+    "Europe/London", "Europe/Paris", "Europe/Berlin", "Europe/Madrid", "Europe/Rome",
+    "Europe/Moscow", "Europe/Istanbul", "Europe/Helsinki", "Africa/Cairo", "Africa/Lagos",
+    "Africa/Johannesburg", "Asia/Dubai", "Asia/Kolkata", "Asia/Bangkok", "Asia/Shanghai",
+    "Asia/Tokyo", "Asia/Seoul", "Asia/Singapore", "Australia/Sydney", "Australia/Perth",
+    "Pacific/Auckland", "Pacific/Honolulu", "Atlantic/Reykjavik", "Asia/Jerusalem"
+]
+
+RRULES = [
+    "FREQ=DAILY",
+    "FREQ=WEEKLY;BYDAY=MO,WE,FR",
+    "FREQ=DAILY;INTERVAL=2;COUNT=200",
+    "FREQ=MONTHLY;BYMONTHDAY=1,15",
+    "FREQ=HOURLY;INTERVAL=6;COUNT=500"
+]
+
+def generate_ics(n_events, recurring, n_timezones, since, days, seed):
+    rand = random.Random(seed)
+    zones = TIMEZONES[:max(1, min(n_timezones, len(TIMEZONES)))]
+    span = days * 24 * 60 * 60
+
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Cinnamon//Calendar Server Benchmark//EN"
+    ]
+
+    for i in range(n_events):
+        start = GLib.DateTime.new_from_unix_utc(since + rand.randrange(span))
+        end = start.add_minutes(rand.choice((15, 30, 60, 90, 120)))
+        all_day = rand.random() < 0.1
+
+        lines.append("BEGIN:VEVENT")
+        lines.append("UID:bench-%06d@cinnamon.org" % i)
+        lines.append("DTSTAMP:20260101T000000Z")
+        lines.append("LAST-MODIFIED:20260101T000000Z")
+        lines.append("SUMMARY:Benchmark event %d" % i)
+
+        if all_day:
+            lines.append("DTSTART;VALUE=DATE:%s" % start.format("%Y%m%d"))
+            lines.append("DTEND;VALUE=DATE:%s" % start.add_days(1).format("%Y%m%d"))
+        else:
+            tzid = rand.choice(zones)
+            lines.append("DTSTART;TZID=%s:%s" % (tzid, start.format("%Y%m%dT%H%M%S")))
+            lines.append("DTEND;TZID=%s:%s" % (tzid, end.format("%Y%m%dT%H%M%S")))
+
+        if rand.random() < recurring:
+            lines.append("RRULE:%s" % rand.choice(RRULES))
+
+        lines.append("END:VEVENT")
+
+    lines.append("END:VCALENDAR")
+
+    return "\r\n".join(lines) + "\r\n"
+
+def parse_ics(ics):
+    vcalendar = ICalGLib.Component.new_from_string(ics)
+    if vcalendar is None:
+        print("Unable to parse calendar data")
+        sys.exit(1)
+
+    components = []
+
+    comp = vcalendar.get_first_component(ICalGLib.ComponentKind.VEVENT_COMPONENT)
+    while comp is not None:
+        # Detach from the parent so each one stands alone, like the components
+        # delivered by an ECal.ClientView.
+        components.append(comp.clone())
+        comp = vcalendar.get_next_component(ICalGLib.ComponentKind.VEVENT_COMPONENT)
+
+    return components
+
+class ReplaySource():
+    def __init__(self):
+        self.uid = "calendar-server-benchmark"
+
+    def get_uid(self):
+        return self.uid
+
+    def get_display_name(self):
+        return "Benchmark"
+
+class ReplayClient():
+    # Stands in for ECal.Client. Recurrences are expanded with the same libecal
+    # routine the real client uses.
+    def __init__(self, zone):
+        self.zone = zone
+        self.tz_lookups = 0
+
+    def get_default_timezone(self):
+        return self.zone
+
+    def set_default_timezone(self, zone):
+        self.zone = zone
+
+    def resolve_tzid(self, tzid, data=None, cancellable=None):
+        self.tz_lookups += 1
+
+        if tzid is None:
+            return None
+
+        return ICalGLib.Timezone.get_builtin_timezone(tzid)
+
+    def generate_instances_for_object_sync(self, ical_comp, start, end, cancellable, callback, user_data):
+        utc = ICalGLib.Timezone.get_utc_timezone()
+
+        def instance_cb(comp, instance_start, instance_end, data, cancellable):
+            instance = comp.clone()
+            instance.set_recurrenceid(instance_start)
+            return callback(instance, instance_start, instance_end, user_data, cancellable)
+
+        ECal.recur_generate_instances_sync(ical_comp,
+                                           ICalGLib.Time.new_from_timet_with_zone(start, False, utc),
+                                           ICalGLib.Time.new_from_timet_with_zone(end, False, utc),
+                                           instance_cb, None,
+                                           self.resolve_tzid, None,
+                                           self.zone,
+                                           cancellable)
+
+class ReplayCalendar():
+    def __init__(self, zone, since, until):
+        self.source = ReplaySource()
+        self.client = ReplayClient(zone)
+        self.color = "#3584e4"
+        self.start = since
+        self.end = until
+        self.view = None
+        self.view_cancellable = Gio.Cancellable()
+
+        self.timezones = {}
+        self.default_zone = None
+        self.recurrences = {}
+
+    # Same memo as CalendarInfo.get_timezone, resolving against libical's
+    # builtin zones instead of an ECal.TimezoneCache.
+    def get_timezone(self, tzid):
+        try:
+            return self.timezones[tzid]
+        except KeyError:
+            timezone = self.client.resolve_tzid(tzid)
+            self.timezones[tzid] = timezone
+            return timezone
+
+    get_default_timezone = calendar_server.CalendarInfo.get_default_timezone
+    clear_timezone_cache = calendar_server.CalendarInfo.clear_timezone_cache
+
+class ReplayInterface():
+    # Records what would have gone out over the bus.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.signals = 0
+        self.events = 0
+        self.bytes = 0
+
+    def emit_events_added_or_updated(self, variant):
+        self.signals += 1
+        self.events += variant.n_children()
+        self.bytes += variant.get_size()
+
+    def emit_events_removed(self, uids_string):
+        self.signals += 1
+        self.events += uids_string.count("::") + 1
+        self.bytes += len(uids_string.encode("utf-8"))
+
+    def emit_client_disappeared(self, uid):
+        self.signals += 1
+
+class ReplayServer():
+    # Borrows the event processing methods of CalendarServer, minus the
+    # Gio.Application, registry and bus plumbing.
+    handle_new_or_modified_objects = calendar_server.CalendarServer.handle_new_or_modified_objects
+    expand_recurrences = calendar_server.CalendarServer.expand_recurrences
+    trim_recurrences = calendar_server.CalendarServer.trim_recurrences
+    generate_recurrences = calendar_server.CalendarServer.generate_recurrences
+    run_recurrence_job = calendar_server.CalendarServer.run_recurrence_job
+    recurrence_job_timed_out = calendar_server.CalendarServer.recurrence_job_timed_out
+    recurrences_generated = calendar_server.CalendarServer.recurrences_generated
+    recurrence_generated = calendar_server.CalendarServer.recurrence_generated
+    handle_removed_objects = calendar_server.CalendarServer.handle_removed_objects
+    event_in_range = calendar_server.CalendarServer.event_in_range
+    emit_events_added_or_updated = calendar_server.CalendarServer.emit_events_added_or_updated
+    get_mod_timet = calendar_server.CalendarServer.get_mod_timet
+    ical_time_get_timet = calendar_server.CalendarServer.ical_time_get_timet
+    create_uid = calendar_server.CalendarServer.create_uid
+    get_id_from_comp_id = calendar_server.CalendarServer.get_id_from_comp_id
+
+    def __init__(self):
+        self.interface = ReplayInterface()
+        self.recurrence_worker = calendar_server.RecurrenceWorker(self.run_recurrence_job, self.recurrences_generated)
+        self.holds = 0
+
+    def hold(self):
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+
+    def wait(self):
+        # Recurrences are generated in the worker thread and handed back
+        # through the main loop, like in the server.
+        context = GLib.MainContext.default()
+        while self.holds > 0:
+            context.iteration(True)
+
+def batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def run_phase(name, func, batches, server):
+    interface = server.interface
+    interface.reset()
+
+    start = time.perf_counter()
+    for batch in batches:
+        func(batch)
+    server.wait()
+    elapsed = time.perf_counter() - start
+
+    rate = interface.events / elapsed if elapsed > 0 else 0
+    print("%-10s %9.3f s %10d events %12.0f events/s %8d signals %12d bytes" %
+          (name, elapsed, interface.events, rate, interface.signals, interface.bytes))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay calendar data through cinnamon-calendar-server's event handling")
+    parser.add_argument("--ics", dest="ics", action="store", metavar="<file>",
+                        help="Replay an existing ICS file instead of generating one")
+    parser.add_argument("--write-ics", dest="write_ics", action="store", metavar="<file>",
+                        help="Save the generated ICS fixture")
+    parser.add_argument("--events", dest="events", type=int, default=5000,
+                        help="Number of events to generate (default: 5000)")
+    parser.add_argument("--recurring", dest="recurring", type=float, default=0.25,
+                        help="Fraction of generated events that recur (default: 0.25)")
+    parser.add_argument("--timezones", dest="timezones", type=int, default=len(TIMEZONES),
+                        help="Number of distinct TZIDs to use (default: %d)" % len(TIMEZONES))
+    parser.add_argument("--since", dest="since", action="store", default="2026-01-01", metavar="<YYYY-MM-DD>",
+                        help="Start of the requested time range (default: 2026-01-01)")
+    parser.add_argument("--days", dest="days", type=int, default=42,
+                        help="Length of the requested time range in days (default: 42, as shown by the applet)")
+    parser.add_argument("--batch", dest="batch", type=int, default=100,
+                        help="Components per objects-added/modified/removed emission (default: 100)")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="Random seed for the generated fixture")
+    args = parser.parse_args()
+
+    since_date = GLib.DateTime.new_from_iso8601(args.since + "T00:00:00Z", None)
+    if since_date is None:
+        print("Invalid --since date: %s" % args.since)
+        sys.exit(1)
+
+    since = since_date.to_unix()
+    until = since_date.add_days(args.days).to_unix()
+
+    if args.ics is not None:
+        with open(args.ics, "r", encoding="utf-8") as f:
+            ics = f.read()
+    else:
+        ics = generate_ics(args.events, args.recurring, args.timezones, since, args.days, args.seed)
+        if args.write_ics is not None:
+            with open(args.write_ics, "w", encoding="utf-8") as f:
+                f.write(ics)
+
+    components = parse_ics(ics)
+    n_recurring = sum(1 for comp in components if ECal.util_component_has_recurrences(comp))
+
+    location = ECal.system_timezone_get_location()
+    if location is None:
+        zone = ICalGLib.Timezone.get_utc_timezone().copy()
+    else:
+        zone = ICalGLib.Timezone.get_builtin_timezone(location).copy()
+
+    server = ReplayServer()
+    calendar = ReplayCalendar(zone, since, until)
+
+    print("%d components (%d recurring), range %s - %s, %d bytes of ICS" %
+          (len(components), n_recurring,
+           GLib.DateTime.new_from_unix_utc(since).format_iso8601(),
+           GLib.DateTime.new_from_unix_utc(until).format_iso8601(),
+           len(ics.encode("utf-8"))))
+
+    run_phase("added",
+              lambda batch: server.handle_new_or_modified_objects(None, batch, calendar),
+              list(batched(components, args.batch)),
+              server)
+
+    # The same, unchanged components again - what a view sees when a month is
+    # revisited. Recurring components are served from their expansion cache.
+    run_phase("reloaded",
+              lambda batch: server.handle_new_or_modified_objects(None, batch, calendar),
+              list(batched(components, args.batch)),
+              server)
+
+    comp_ids = [ECal.ComponentId.new(comp.get_uid(), None) for comp in components]
+    run_phase("removed",
+              lambda batch: server.handle_removed_objects(None, batch, calendar),
+              list(batched(comp_ids, args.batch)),
+              server)
+
+    print("timezone lookups: %d" % calendar.client.tz_lookups)
+    print("peak RSS: %d KiB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,9 @@ import gettext
 import functools
 import logging
 import time
+import queue
+import threading
+from collections import namedtuple
 from setproctitle import setproctitle
 import signal
 
@@ -26,6 +29,12 @@ STATUS_UNKNOWN = 0
 STATUS_NO_CALENDARS = 1
 STATUS_HAS_CALENDARS = 2
 
+# How many ECal.Client connections to have in flight at once
+MAX_PENDING_CONNECTIONS = 8
+
+# A recurrence expansion taking longer than this is given up (seconds)
+RECURRENCE_TIMEOUT = 30
+
 class CalendarInfo(GObject.Object):
     __gsignals__ = {
         "color-changed": (GObject.SignalFlags.RUN_LAST, None, ()),
@@ -57,6 +66,14 @@ class CalendarInfo(GObject.Object):
         self.view_cancellable = None
         self.events = []
 
+        # TZID -> ICalGLib.Timezone, resolving through ECal.TimezoneCache is
+        # expensive and the same few zones get referenced by every event.
+        self.timezones = {}
+        self.default_zone = None
+
+        # component uid -> RecurrenceCache
+        self.recurrences = {}
+
     def try_sync(self):
         if self.syncing:
             return
@@ -75,6 +92,24 @@ class CalendarInfo(GObject.Object):
 
         self.syncing = False
 
+    def get_timezone(self, tzid):
+        try:
+            return self.timezones[tzid]
+        except KeyError:
+            timezone = ECal.TimezoneCache.get_timezone(self.client, tzid)
+            self.timezones[tzid] = timezone
+            return timezone
+
+    def get_default_timezone(self):
+        if self.default_zone is None:
+            self.default_zone = self.client.get_default_timezone()
+
+        return self.default_zone
+
+    def clear_timezone_cache(self):
+        self.timezones = {}
+        self.default_zone = None
+
     def destroy(self):
         self.extension.disconnect(self.color_prop_listener_id)
         self.extension = None
@@ -92,9 +127,106 @@ class CalendarInfo(GObject.Object):
         self.color = self.extension.get_color()
         self.emit("color-changed")
 
-class Event:
-    def __init__(self, uid, color, summary, all_day, start_timet, end_timet, mod_timet):
-        self.__dict__.update(locals())
+# Field order matches the (sssbxxx) tuples sent over the bus, so a list of
+# these can be handed straight to GLib.Variant.
+Event = namedtuple("Event", ["uid", "color", "summary", "all_day", "start_timet", "end_timet", "mod_timet"])
+
+class RecurrenceCache():
+    # Instances already generated for a recurring component, and the time
+    # spans they were generated for. Only valid for a given mod_timet.
+    def __init__(self, mod_timet):
+        self.mod_timet = mod_timet
+        self.ranges = []
+        self.events = {}
+        # RecurrenceJobs of the spans being generated
+        self.pending = []
+
+    def get_missing_ranges(self, start, end):
+        missing = []
+
+        covered = self.ranges + [(job.start, job.end) for job in self.pending if not job.is_cancelled()]
+
+        for range_start, range_end in sorted(covered):
+            if range_end <= start:
+                continue
+            if range_start >= end:
+                break
+            if range_start > start:
+                missing.append((start, range_start))
+            start = max(start, range_end)
+
+        if start < end:
+            missing.append((start, end))
+
+        return missing
+
+    def add_range(self, start, end):
+        merged = []
+
+        for range_start, range_end in sorted(self.ranges + [(start, end)]):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+            else:
+                merged.append((range_start, range_end))
+
+        self.ranges = merged
+
+    def trim(self, start, end):
+        # Forget whatever lies outside of start - end.
+        self.ranges = [(max(range_start, start), min(range_end, end)) for range_start, range_end in self.ranges
+                       if range_end > start and range_start < end]
+        self.events = {uid: event for uid, event in self.events.items()
+                       if event.end_timet > start and event.start_timet < end}
+
+class RecurrenceJob():
+    # One span of a recurring component to generate. Everything the worker
+    # thread needs is resolved on the main thread beforehand, and it only
+    # writes to events.
+    def __init__(self, calendar, ical_comp, cache, start, end):
+        self.calendar = calendar
+        self.ical_comp = ical_comp.clone()
+        self.uid = ical_comp.get_uid()
+        self.cache = cache
+        self.mod_timet = cache.mod_timet
+        self.start = start
+        self.end = end
+        self.default_zone = calendar.get_default_timezone()
+        self.view_cancellable = calendar.view_cancellable
+        # cancelled when the job times out
+        self.cancellable = Gio.Cancellable()
+        self.timeout_id = 0
+        self.finished = False
+        self.events = {}
+
+    def is_cancelled(self):
+        return self.cancellable.is_cancelled() or self.view_cancellable.is_cancelled()
+
+class RecurrenceWorker():
+    # Runs jobs one at a time in a thread of its own, and hands every job back
+    # to the main loop once it's over, however it ended. The thread is a daemon
+    # so that a stuck job can't keep the server from exiting.
+    def __init__(self, run_func, done_func):
+        self.run_func = run_func
+        self.done_func = done_func
+        self.jobs = queue.Queue()
+        self.thread = None
+
+    def add(self, job):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self.run_func(job)
+            except Exception as e:
+                print("Unable to generate recurrences:", e)
+            finally:
+                GLib.idle_add(self.done_func, job)
 
 class CalendarServer(Gio.Application):
     def __init__(self, hold=False):
@@ -113,6 +245,11 @@ class CalendarServer(Gio.Application):
         self.client_disappeared_id = 0
 
         self.calendars = {}
+        self.recurrence_worker = RecurrenceWorker(self.run_recurrence_job, self.recurrences_generated)
+
+        self.queued_sources = []
+        self.connecting = {}
+        self.connection_latency = {}
 
         self.current_month_start = 0
         self.current_month_end = 0
@@ -120,6 +257,12 @@ class CalendarServer(Gio.Application):
         self.zone = None
         self.update_timezone()
 
+        self.system_bus = None
+        self.timedate_signal_id = 0
+        self.timezone_monitors = []
+        self.timezone_changed_id = 0
+        self.watch_timezone()
+
         try:
             self.session_bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
         except:
@@ -136,6 +279,60 @@ class CalendarServer(Gio.Application):
         except GLib.Error as e:
             print("couldn't register on bus: ", e.message)
 
+    def watch_timezone(self):
+        # timedated announces changes made through it, the file monitors catch the rest.
+        try:
+            self.system_bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+            self.timedate_signal_id = self.system_bus.signal_subscribe("org.freedesktop.timedate1",
+                                                                       "org.freedesktop.DBus.Properties",
+                                                                       "PropertiesChanged",
+                                                                       "/org/freedesktop/timedate1",
+                                                                       None,
+                                                                       Gio.DBusSignalFlags.NONE,
+                                                                       self.on_timedate_properties_changed,
+                                                                       None)
+        except GLib.Error as e:
+            print("Unable to watch for timezone changes from timedated:", e.message)
+
+        for path in ("/etc/localtime", "/etc/timezone"):
+            try:
+                monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.WATCH_MOVES, None)
+                monitor.connect("changed", self.on_timezone_file_changed)
+                self.timezone_monitors.append(monitor)
+            except GLib.Error as e:
+                print("Unable to monitor %s:" % path, e.message)
+
+    def on_timedate_properties_changed(self, connection, sender, path, iface, signal, params, data=None):
+        changed, invalidated = params.unpack()[1:]
+        if "Timezone" in changed or "Timezone" in invalidated:
+            self.queue_timezone_changed()
+
+    def on_timezone_file_changed(self, monitor, file, other_file, event_type):
+        self.queue_timezone_changed()
+
+    def queue_timezone_changed(self):
+        # Both sources usually fire for a single change.
+        if self.timezone_changed_id > 0:
+            GLib.source_remove(self.timezone_changed_id)
+        self.timezone_changed_id = GLib.timeout_add(500, self.on_timezone_changed)
+
+    def on_timezone_changed(self):
+        self.timezone_changed_id = 0
+
+        location = ECal.system_timezone_get_location()
+        if location == self.zone.get_location() or (location is None and self.zone.get_location() == "UTC"):
+            return GLib.SOURCE_REMOVE
+
+        print("System timezone changed to", location)
+        self.update_timezone()
+
+        # Floating and all-day times depend on the default zone.
+        if self.current_month_start != 0 and self.current_month_end != 0:
+            for calendar in self.calendars.values():
+                self.create_view_for_calendar(calendar)
+
+        return GLib.SOURCE_REMOVE
+
     def update_timezone(self):
         location = ECal.system_timezone_get_location()
 
@@ -144,6 +341,11 @@ class CalendarServer(Gio.Application):
         else:
             self.zone = ICalGLib.Timezone.get_builtin_timezone(location).copy()
 
+        for calendar in self.calendars.values():
+            calendar.client.set_default_timezone(self.zone)
+            calendar.clear_timezone_cache()
+            calendar.recurrences = {}
+
     def do_startup(self):
         Gio.Application.do_startup(self)
 
@@ -181,33 +383,69 @@ class CalendarServer(Gio.Application):
         print("Discovered calendar: ", source.get_display_name())
 
         self.hold()
-        ECal.Client.connect(source, ECal.ClientSourceType.EVENTS, 10, None, self.ecal_client_connected, source)
+        self.queued_sources.append(source)
+        self.connect_queued_sources()
+
+    def connect_queued_sources(self):
+        # Sources are all reported at once by reclaim() - let several connect
+        # in parallel, but don't open a connection to every backend at once.
+        while self.queued_sources and len(self.connecting) < MAX_PENDING_CONNECTIONS:
+            source = self.queued_sources.pop(0)
+            self.connecting[source.get_uid()] = GLib.get_monotonic_time()
+
+            ECal.Client.connect(source, ECal.ClientSourceType.EVENTS, 10, None, self.ecal_client_connected, source)
 
         # ??? should be (self, source, res) but we get the client instead
     def ecal_client_connected(self, c, res, source):
         self.release()
 
+        uid = source.get_uid()
+        started = self.connecting.pop(uid, None)
+        self.connect_queued_sources()
+
         try:
             client = ECal.Client.connect_finish(res)
-            client.set_default_timezone(self.zone)
-
-            calendar = CalendarInfo(source, client)
-            calendar.owner_color_signal_id = calendar.connect("color-changed", self.source_color_changed)
-            self.calendars[source.get_uid()] = calendar
-
-            self.update_status()
-
-            if self.current_month_start != 0 and self.current_month_end != 0:
-                self.create_view_for_calendar(calendar)
         except GLib.Error as e:
             # what to do
             print("couldn't connect to source", e.message)
             return
 
+        if started is not None:
+            self.update_connection_latency(source, (GLib.get_monotonic_time() - started) // 1000)
+
+        client.set_default_timezone(self.zone)
+
+        calendar = CalendarInfo(source, client)
+        calendar.owner_color_signal_id = calendar.connect("color-changed", self.source_color_changed)
+        self.calendars[uid] = calendar
+
+        # A connected calendar is always a relevant one, there's no need to
+        # walk the registry again.
+        if self.interface.get_property("status") != STATUS_HAS_CALENDARS:
+            self.interface.set_property("status", STATUS_HAS_CALENDARS)
+
+        if self.current_month_start != 0 and self.current_month_end != 0:
+            self.create_view_for_calendar(calendar)
+
+    def update_connection_latency(self, source, msec):
+        print("Connected to calendar '%s' in %d ms" % (source.get_display_name(), msec))
+
+        self.connection_latency[source.get_uid()] = (source.get_display_name(), msec)
+        self.publish_connection_latency()
+
+    def publish_connection_latency(self):
+        latency = [(uid, name, msec) for uid, (name, msec) in self.connection_latency.items()]
+        self.interface.set_property("connection-latency", GLib.Variant("a(ssx)", latency))
+
     def source_color_changed(self, calendar):
         self.create_view_for_calendar(calendar)
 
     def source_disappeared(self, watcher, source):
+        if source in self.queued_sources:
+            self.queued_sources.remove(source)
+            self.release()
+            return
+
         try:
             calendar = self.calendars[source.get_uid()]
         except KeyError:
@@ -219,6 +457,9 @@ class CalendarServer(Gio.Application):
 
         del self.calendars[source.get_uid()]
 
+        if self.connection_latency.pop(source.get_uid(), None) is not None:
+            self.publish_connection_latency()
+
         self.update_status()
 
     def update_status(self):
@@ -287,6 +528,7 @@ class CalendarServer(Gio.Application):
 
         calendar.start = self.current_month_start
         calendar.end = self.current_month_end
+        self.trim_recurrences(calendar)
 
         query = "occur-in-time-range? (make-time \"%s\") (make-time \"%s\") \"%s\"" %\
                  (from_iso, to_iso, self.zone.get_location())
@@ -338,35 +580,34 @@ class CalendarServer(Gio.Application):
 
             if (not ECal.util_component_is_instance (ical_comp)) and \
               ECal.util_component_has_recurrences(ical_comp):
-                calendar.client.generate_instances_for_object(
-                    ical_comp,
-                    calendar.start,
-                    calendar.end,
-                    calendar.view_cancellable,
-                    self.recurrence_generated,
-                    calendar
-                )
+                events.extend(self.expand_recurrences(calendar, ical_comp))
             else:
-                comp = ECal.Component.new_from_icalcomponent(ical_comp)
-                comptext = comp.get_summary()
-                if comptext is not None:
-                    summary = comptext.get_value()
-                else:
-                    summary = ""
+                # A detached instance changes what its master expands to.
+                calendar.recurrences.pop(ical_comp.get_uid(), None)
 
                 dts_prop = ical_comp.get_first_property(ICalGLib.PropertyKind.DTSTART_PROPERTY)
                 ical_time_start = dts_prop.get_dtstart()
-                start_timet = self.ical_time_get_timet(calendar.client, ical_time_start, dts_prop)
+                start_timet = self.ical_time_get_timet(calendar, ical_time_start, dts_prop)
                 all_day = ical_time_start.is_date()
 
                 dte_prop = ical_comp.get_first_property(ICalGLib.PropertyKind.DTEND_PROPERTY)
 
                 if dte_prop is not None:
                     ical_time_end = dte_prop.get_dtend()
-                    end_timet = self.ical_time_get_timet(calendar.client, ical_time_end, dte_prop)
+                    end_timet = self.ical_time_get_timet(calendar, ical_time_end, dte_prop)
                 else:
                     end_timet = start_timet + (60 * 30) # Default to 30m if the end time is bad.
 
+                if not self.event_in_range(calendar, start_timet, end_timet):
+                    continue
+
+                comp = ECal.Component.new_from_icalcomponent(ical_comp)
+                comptext = comp.get_summary()
+                if comptext is not None:
+                    summary = comptext.get_value()
+                else:
+                    summary = ""
+
                 mod_timet = self.get_mod_timet(ical_comp)
 
                 event = Event(
@@ -385,33 +626,146 @@ class CalendarServer(Gio.Application):
 
         self.release()
 
-    def recurrence_generated(self, ical_comp, instance_start, instance_end, calendar, cancellable):
-        if calendar.view_cancellable.is_cancelled():
-            return False
+    def trim_recurrences(self, calendar):
+        # Keep the expansions for the window being shown and the ones next to
+        # it, so a long-running server doesn't hold every span ever viewed.
+        span = calendar.end - calendar.start
+        keep_start = calendar.start - span
+        keep_end = calendar.end + span
+
+        for uid in list(calendar.recurrences.keys()):
+            cache = calendar.recurrences[uid]
+            cache.trim(keep_start, keep_end)
+            if not cache.ranges and not cache.pending:
+                del calendar.recurrences[uid]
+
+    def expand_recurrences(self, calendar, ical_comp):
+        uid = ical_comp.get_uid()
+        mod_timet = self.get_mod_timet(ical_comp)
 
-        comp = ECal.Component.new_from_icalcomponent(ical_comp)
-        all_objects = GLib.VariantBuilder(GLib.VariantType.new("a(sssbxx)"))
+        # Without a modification time there's no telling whether a cached
+        # expansion is stale, so always start over.
+        cache = calendar.recurrences.get(uid)
+        if cache is None or mod_timet == 0 or cache.mod_timet != mod_timet:
+            cache = RecurrenceCache(mod_timet)
+            calendar.recurrences[uid] = cache
 
-        comptext = comp.get_summary()
-        if comptext is not None:
-            summary = comptext.get_value()
-        else:
-            summary = ""
+        # Missing spans are generated in the background, their events are sent
+        # once they're complete.
+        for start, end in cache.get_missing_ranges(calendar.start, calendar.end):
+            self.generate_recurrences(calendar, ical_comp, cache, start, end)
+
+        events = []
+
+        for event in cache.events.values():
+            if not self.event_in_range(calendar, event.start_timet, event.end_timet):
+                continue
+
+            if event.color != calendar.color:
+                event = event._replace(color=calendar.color)
+
+            events.append(event)
+
+        return events
+
+    def generate_recurrences(self, calendar, ical_comp, cache, start, end):
+        self.hold()
+
+        job = RecurrenceJob(calendar, ical_comp, cache, start, end)
+        cache.pending.append(job)
+        self.recurrence_worker.add(job)
+
+    def run_recurrence_job(self, job):
+        # In the worker thread. The timeout only starts once the job does, so
+        # a long queue doesn't time out the jobs waiting in it.
+        if job.is_cancelled():
+            return
+
+        job.timeout_id = GLib.timeout_add_seconds(RECURRENCE_TIMEOUT, self.recurrence_job_timed_out, job)
+
+        job.calendar.client.generate_instances_for_object_sync(
+            job.ical_comp,
+            job.start,
+            job.end,
+            job.cancellable,
+            self.recurrence_generated,
+            job
+        )
+
+    def recurrence_job_timed_out(self, job):
+        job.timeout_id = 0
+        print("Gave up generating the recurrences of", job.uid)
+
+        # Stops the generator, the span is generated again next time it's needed
+        job.cancellable.cancel()
+        self.recurrences_generated(job)
+
+        return GLib.SOURCE_REMOVE
+
+    def recurrences_generated(self, job):
+        if job.finished:
+            return GLib.SOURCE_REMOVE
+        job.finished = True
 
-        default_zone = calendar.client.get_default_timezone()
+        if job.timeout_id > 0:
+            GLib.source_remove(job.timeout_id)
+            job.timeout_id = 0
+
+        self.release()
+
+        cache = job.cache
+        cache.pending.remove(job)
+
+        # Cancelled generations may be incomplete, and a modified component
+        # has a new cache already.
+        if job.is_cancelled() or job.calendar.recurrences.get(job.uid) is not cache:
+            return GLib.SOURCE_REMOVE
+
+        cache.events.update(job.events)
+        cache.add_range(job.start, job.end)
+
+        in_range = []
+        for event in job.events.values():
+            if not self.event_in_range(job.calendar, event.start_timet, event.end_timet):
+                continue
+
+            if event.color != job.calendar.color:
+                event = event._replace(color=job.calendar.color)
+
+            in_range.append(event)
+
+        if len(in_range) > 0:
+            self.emit_events_added_or_updated(job.calendar, in_range)
+
+        return GLib.SOURCE_REMOVE
+
+    def recurrence_generated(self, ical_comp, instance_start, instance_end, job, cancellable):
+        # Called from the worker thread.
+        if job.is_cancelled():
+            return False
+
+        calendar = job.calendar
 
         dts_timezone = instance_start.get_timezone()
         if dts_timezone is None:
-            dts_timezone = default_zone
+            dts_timezone = job.default_zone
 
         dte_timezone = instance_end.get_timezone()
         if dte_timezone is None:
-            dte_timezone = default_zone
+            dte_timezone = job.default_zone
 
-        all_day = instance_start.is_date()
         start_timet = instance_start.as_timet_with_zone(dts_timezone)
         end_timet = instance_end.as_timet_with_zone(dte_timezone)
-        mod_timet = self.get_mod_timet(ical_comp)
+
+        comp = ECal.Component.new_from_icalcomponent(ical_comp)
+
+        comptext = comp.get_summary()
+        if comptext is not None:
+            summary = comptext.get_value()
+        else:
+            summary = ""
+
+        all_day = instance_start.is_date()
 
         event = Event(
             self.create_uid(calendar, comp),
@@ -420,37 +774,21 @@ class CalendarServer(Gio.Application):
             all_day,
             start_timet,
             end_timet,
-            mod_timet
+            job.mod_timet
         )
 
-        self.emit_events_added_or_updated(calendar, [event])
+        job.events[event.uid] = event
 
         return True
 
+    def event_in_range(self, calendar, start_timet, end_timet):
+        return not (end_timet <= (calendar.start - 1) or start_timet >= calendar.end)
+
     def emit_events_added_or_updated(self, calendar, events):
         # print("package: ",len(events))
-        all_events = GLib.VariantBuilder(GLib.VariantType.new("a(sssbxxx)"))
-
-        for event in events:
-            if event.end_timet <= (calendar.start - 1) and event.start_timet >= calendar.end:
-                continue
-
-            event_var = GLib.Variant(
-                "(sssbxxx)",
-                [
-                    event.uid,
-                    event.color,
-                    event.summary,
-                    event.all_day,
-                    event.start_timet,
-                    event.end_timet,
-                    event.mod_timet
-                ]
-            )
+        all_events = GLib.Variant("a(sssbxxx)", events)
 
-            all_events.add_value(event_var)
-
-        self.interface.emit_events_added_or_updated(all_events.end())
+        self.interface.emit_events_added_or_updated(all_events)
 
     def get_mod_timet(self, ical_comp):
         # Both last-modified and created are optional. Try one, then the other,
@@ -471,14 +809,14 @@ class CalendarServer(Gio.Application):
 
         return mod_timet
 
-    def ical_time_get_timet(self, client, ical_time, prop):
+    def ical_time_get_timet(self, calendar, ical_time, prop):
         tzid  = prop.get_first_parameter(ICalGLib.ParameterKind.TZID_PARAMETER)
         if tzid:
-            timezone = ECal.TimezoneCache.get_timezone(client, tzid.get_tzid())
+            timezone = calendar.get_timezone(tzid.get_tzid())
         elif ical_time.is_utc():
             timezone = ICalGLib.Timezone.get_utc_timezone()
         else:
-            timezone = client.get_default_timezone()
+            timezone = calendar.get_default_timezone()
 
         ical_time.set_timezone(timezone)
         return ical_time.as_timet_with_zone(timezone)
@@ -507,12 +845,22 @@ class CalendarServer(Gio.Application):
             uid = self.get_id_from_comp_id(comp_id, source_id)
             uids.append(uid)
 
+            calendar.recurrences.pop(comp_id.get_uid(), None)
+
         uids_string = "::".join(uids)
 
         if uids_string != "":
             self.interface.emit_events_removed(uids_string)
 
     def exit(self):
+        if self.timedate_signal_id > 0:
+            self.system_bus.signal_unsubscribe(self.timedate_signal_id)
+            self.timedate_signal_id = 0
+
+        for monitor in self.timezone_monitors:
+            monitor.cancel()
+        self.timezone_monitors = []
+
         if self.registry_watcher is not None:
             self.registry_watcher.disconnect(self.client_appeared_id)
             self.registry_watcher.disconnect(self.client_disappeared_id)
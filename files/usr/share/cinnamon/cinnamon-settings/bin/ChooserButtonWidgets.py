@@ -4,8 +4,68 @@ from gi.repository import Gtk, GObject, GLib, Gdk, GdkPixbuf, Gio
 import os
 import gettext
 import datetime
+import collections
+import concurrent.futures
 gettext.install("cinnamon", "/usr/share/locale")
 
+THUMBNAIL_WORKERS = 4
+THUMBNAIL_CACHE_SIZE = 256
+
+class ThumbnailLoader:
+    """ loads scaled pictures in a bounded pool of worker threads. The resulting surfaces
+        are kept, keyed by path, mtime, size and scale. """
+    def __init__(self):
+        self.pool = None
+        self.surfaces = collections.OrderedDict()
+
+    def get_key(self, path, width, height, scale):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        return (path, mtime, width, height, scale)
+
+    def lookup(self, key):
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def load(self, key, cancellable, callback, *data):
+        """ calls callback(surface, *data) from the main loop, unless cancellable was cancelled """
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        future = self.pool.submit(self.load_thread, key, cancellable)
+        future.add_done_callback(lambda future: GLib.idle_add(self.on_loaded, key, future, cancellable, callback, data))
+
+    def load_thread(self, key, cancellable):
+        # skip loads that were queued for a menu which was since cleared
+        if cancellable.is_cancelled():
+            return None
+        (path, mtime, width, height, scale) = key
+        return GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
+
+    def on_loaded(self, key, future, cancellable, callback, data):
+        if cancellable.is_cancelled():
+            return False
+
+        surface = None
+        try:
+            pixbuf = future.result()
+            if pixbuf:
+                surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, key[4])
+                self.surfaces[key] = surface
+                while len(self.surfaces) > THUMBNAIL_CACHE_SIZE:
+                    self.surfaces.popitem(last=False)
+        except GLib.Error as e:
+            print("Could not load thumbnail file '%s': %s" % (key[0], e.message))
+        finally:
+            # whatever happened, the caller is waiting for this one
+            callback(surface, *data)
+        return False
+
+thumbnail_loader = ThumbnailLoader()
+
 class BaseChooserButton(Gtk.Button):
     def __init__ (self, has_button_label=False, frame=False):
         super(BaseChooserButton, self).__init__()
@@ -76,6 +136,10 @@ class PictureChooserButton(BaseChooserButton):
         self.row = 0
         self.col = 0
         self.progress = 0.0
+        self.loading = 0
+        self.loaded = 0
+        self.menu_cancellable = Gio.Cancellable()
+        self.button_cancellable = Gio.Cancellable()
 
         context = self.get_style_context()
         context.add_class("gtkstyle-fallback")
@@ -121,9 +185,13 @@ class PictureChooserButton(BaseChooserButton):
         self.progress = 0.0
         self.queue_draw()
 
-    def create_scaled_surface(self, path):
+    def get_surface_size(self):
         w = self.button_picture_width * self.scale
         h = -1 if not self.keep_square else self.button_picture_width * self.scale
+        return w, h
+
+    def create_scaled_surface(self, path):
+        w, h = self.get_surface_size()
 
         try:
             pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path, w, h)
@@ -133,8 +201,28 @@ class PictureChooserButton(BaseChooserButton):
             print("Could not load thumbnail file '%s': %s" % (path, e.message))
         return None
 
+    def load_surface(self, path, cancellable, callback, *data):
+        """ calls callback(surface, *data) right away if the picture is cached, or once it's loaded """
+        w, h = self.get_surface_size()
+        key = thumbnail_loader.get_key(path, w, h, self.scale)
+        if key is None:
+            print("Could not load thumbnail file '%s'" % path)
+            callback(None, *data)
+            return
+
+        surface = thumbnail_loader.lookup(key)
+        if surface is not None:
+            callback(surface, *data)
+        else:
+            thumbnail_loader.load(key, cancellable, callback, *data)
+
     def set_picture_from_file (self, path):
-        surface = self.create_scaled_surface(path)
+        # a newer picture replaces one which is still loading
+        self.button_cancellable.cancel()
+        self.button_cancellable = Gio.Cancellable()
+        self.load_surface(path, self.button_cancellable, self.on_button_surface_loaded)
+
+    def on_button_surface_loaded(self, surface):
         if surface:
             self.button_image.set_from_surface(surface)
         else:
@@ -144,16 +232,24 @@ class PictureChooserButton(BaseChooserButton):
         if self.has_button_label:
             self.button_label.set_markup(label)
 
-    def _on_picture_selected(self, menuitem, path, callback, id=None):
+    def _on_picture_selected(self, menuitem, callback, id=None):
+        path = menuitem.picture_path
         if id is not None:
             result = callback(path, id)
         else:
             result = callback(path)
 
-        if result:
+        if result and path is not None:
             self.set_picture_from_file(path)
 
     def clear_menu(self):
+        # pictures still loading for the old menu are dropped
+        self.menu_cancellable.cancel()
+        self.menu_cancellable = Gio.Cancellable()
+        self.loading = 0
+        self.loaded = 0
+        self.reset_loading_progress()
+
         menu = self.menu
         self.menu = Gtk.Menu()
         self.row = 0
@@ -164,12 +260,8 @@ class PictureChooserButton(BaseChooserButton):
         image = Gtk.Image()
         image.set_size_request(self.menu_picture_width / self.scale, -1)
 
-        surface = self.create_scaled_surface(path)
-
-        if surface:
-            image.set_from_surface(surface)
-        else:
-            image.set_from_icon_name("user-generic", Gtk.IconSize.BUTTON)
+        # a placeholder is shown until the picture is loaded, or until set_item_picture() is called
+        image.set_from_icon_name("user-generic", Gtk.IconSize.BUTTON)
 
         if self.frame:
             frame = Gtk.Frame(halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER)
@@ -188,15 +280,45 @@ class PictureChooserButton(BaseChooserButton):
             menuitem.add(vbox)
         else:
             menuitem.add(menu_image)
+        menuitem.picture_path = path
+        menuitem.picture_image = image
         if id is not None:
-            menuitem.connect('activate', self._on_picture_selected, path, callback, id)
+            menuitem.connect('activate', self._on_picture_selected, callback, id)
         else:
-            menuitem.connect('activate', self._on_picture_selected, path, callback)
+            menuitem.connect('activate', self._on_picture_selected, callback)
         self.menu.attach(menuitem, self.col, self.col+1, self.row, self.row+1)
         self.col = (self.col+1) % self.num_cols
         if self.col == 0:
             self.row = self.row + 1
 
+        if path is not None:
+            self.load_item_picture(menuitem, path)
+
+        return menuitem
+
+    def set_item_picture(self, menuitem, path):
+        menuitem.picture_path = path
+        self.load_item_picture(menuitem, path)
+
+    def load_item_picture(self, menuitem, path):
+        self.loading += 1
+        self.load_surface(path, self.menu_cancellable, self.on_item_surface_loaded, menuitem)
+
+    def on_item_surface_loaded(self, surface, menuitem):
+        try:
+            if surface:
+                menuitem.picture_image.set_from_surface(surface)
+        finally:
+            # the progress bar is shown while pictures are loading
+            self.loaded += 1
+            if self.loaded >= self.loading:
+                self.loading = 0
+                self.loaded = 0
+                self.reset_loading_progress()
+            else:
+                self.progress = self.loaded / self.loading
+                self.queue_draw()
+
     def add_separator(self):
         self.row = self.row + 1
         self.menu.attach(Gtk.SeparatorMenuItem(), 0, self.num_cols, self.row, self.row+1)
@@ -6,16 +6,19 @@ import re
 import html
 import subprocess
 import gettext
+import json
+import threading
 from html.parser import HTMLParser
 from html import entities
 import locale
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gio, Gtk, Gdk, GdkPixbuf, GLib
+from gi.repository import Gio, Gtk, Gdk, GdkPixbuf, GLib, GObject
 
 from xapp.SettingsWidgets import SettingsPage, SettingsWidget, SettingsLabel
 from Spices import ThreadedTaskManager
+import fileutil
 
 home = os.path.expanduser('~')
 
@@ -29,7 +32,16 @@ SETTING_TYPE_EXTERNAL = 2
 
 ROW_SIZE = 32
 
+# Number of rows added to the download list at a time, as it's scrolled
+DOWNLOAD_PAGE_SIZE = 50
+
 UNSAFE_ITEMS = ['spawn_sync', 'spawn_command_line_sync', 'GTop', 'get_file_contents_utf8_sync']
+UNSAFE_PATTERN = re.compile(b'|'.join(re.escape(item.encode('utf-8')) for item in UNSAFE_ITEMS))
+# A match may straddle two chunks, keep enough of the previous one to find it
+UNSAFE_OVERLAP = max(len(item.encode('utf-8')) for item in UNSAFE_ITEMS) - 1
+SCAN_CHUNK_SIZE = 64 * 1024
+
+SCAN_CACHE_FILE = os.path.join(GLib.get_user_cache_dir(), 'cinnamon', 'spices', 'danger-scan.json')
 
 LANGUAGE_CODE = LONG_LANGUAGE_CODE = "C"
 try:
@@ -96,12 +108,37 @@ def list_header_func(row, before, user_data):
         row.set_header(Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL))
 
 
+def make_search_text(*parts):
+    return '\n'.join(parts).lower()
+
+
 def filter_row(row, entry):
-    search_string = entry.get_text().lower()
-    for row_part in [row.name, row.description, row.uuid, row.author]:
-        if search_string.lower() in row_part.lower():
-            return True
-    return False
+    return entry.get_text().lower() in row.search_text
+
+
+class SearchIndex():
+    """ Substring search over a list of items with a precomputed search_text.
+        Results keep the order of the list, and when a search string extends
+        a previous one only that one's results are scanned again. """
+    def __init__(self, items):
+        self.items = items
+        # only the results of the current query and of its prefixes are kept
+        self.results = {'': items}
+
+    def search(self, query):
+        query = query.lower()
+
+        self.results = {prefix: results for prefix, results in self.results.items() if query.startswith(prefix)}
+        if query in self.results:
+            return self.results[query]
+
+        # the longest prefix has the fewest results to look through
+        candidates = self.results[max(self.results, key=len)]
+        results = [item for item in candidates if query in item.search_text]
+
+        self.results[query] = results
+
+        return results
 
 
 def show_prompt(msg, window=None):
@@ -132,6 +169,97 @@ def show_message(msg, window=None):
 background_work_queue = ThreadedTaskManager(5)
 
 
+class DangerScanner():
+    """ Looks for UNSAFE_ITEMS in the .js files of a spice. Results are kept on disk per
+        file, keyed by size and mtime, so unchanged spices aren't read again. """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.cache = None
+        self.lock = threading.Lock()
+        self.save_id = 0
+
+    def load(self):
+        try:
+            with open(self.cache_file, encoding='utf-8') as cache:
+                self.cache = json.load(cache)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def scan(self, directory):
+        """ returns True if any .js file in directory contains an unsafe call. Called from
+            worker threads """
+        with self.lock:
+            if self.cache is None:
+                self.load()
+            old_results = self.cache.get(directory, {})
+
+        results = {}
+        dangerous = False
+
+        try:
+            for path, stat in self.walk(directory):
+                key = os.path.relpath(path, directory)
+                cached = old_results.get(key)
+
+                if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                    file_dangerous = cached[2]
+                else:
+                    file_dangerous = self.scan_file(path)
+
+                results[key] = [stat.st_size, stat.st_mtime_ns, file_dangerous]
+                dangerous = dangerous or file_dangerous
+        except OSError:
+            # Don't trust (or cache) anything we couldn't fully read
+            return True
+
+        with self.lock:
+            self.cache[directory] = results
+
+        return dangerous
+
+    def walk(self, directory):
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                yield from self.walk(entry.path)
+            elif entry.name.endswith('.js'):
+                yield entry.path, entry.stat()
+
+    def scan_file(self, path):
+        tail = b''
+        with open(path, 'rb') as scan_file:
+            while True:
+                chunk = scan_file.read(SCAN_CHUNK_SIZE)
+                if not chunk:
+                    return False
+
+                data = tail + chunk
+                if UNSAFE_PATTERN.search(data):
+                    return True
+                tail = data[-UNSAFE_OVERLAP:]
+
+    def queue_save(self):
+        if self.save_id == 0:
+            self.save_id = GLib.timeout_add_seconds(2, self.save)
+
+    def save(self):
+        self.save_id = 0
+
+        with self.lock:
+            # forget spices that have been removed since
+            cache = {directory: results for directory, results in self.cache.items() if os.path.isdir(directory)}
+            self.cache = cache
+
+            try:
+                fileutil.save_cache_file(self.cache_file, cache)
+            except OSError as e:
+                print(f"Could not save the spice scan cache: {e}")
+
+        return GLib.SOURCE_REMOVE
+
+
+danger_scanner = DangerScanner(SCAN_CACHE_FILE)
+
+
 class MyHTMLParser(HTMLParser):
     def __init__(self):
         HTMLParser.__init__(self)
@@ -180,6 +308,9 @@ class ManageSpicesRow(Gtk.ListBoxRow):
             if metadata['author'].lower() != "none" and metadata['author'].lower() != "unknown":
                 self.author = metadata['author']
 
+        self.sort_name = self.name.lower()
+        self.search_text = make_search_text(self.name, self.description, self.uuid, self.author)
+
         try:
             self.max_instances = int(self.metadata['max-instances'])
             if self.max_instances < -1:
@@ -389,32 +520,11 @@ class ManageSpicesRow(Gtk.ListBoxRow):
         background_work_queue.push(self.scan_extension_thread, self.on_scan_complete, (directory,))
 
     def scan_extension_thread(self, directory):
-        dangerous = False
-
-        def scan_item(item):
-            if item.endswith('.js'):
-                with open(item, encoding="utf-8") as scan_file:
-                    contents = scan_file.read()
-                    for unsafe_item in UNSAFE_ITEMS:
-                        if unsafe_item in contents:
-                            raise Exception('unsafe')
-
-        def scan_dir(subdir):
-            for item in os.listdir(subdir):
-                item_path = os.path.join(subdir, item)
-                if os.path.isdir(item_path):
-                    scan_dir(item_path)
-                else:
-                    scan_item(item_path)
-
-        try:
-            scan_dir(directory)
-        except:
-            dangerous = True
-
-        return dangerous
+        return danger_scanner.scan(directory)
 
     def on_scan_complete(self, is_dangerous):
+        danger_scanner.queue_save()
+
         if is_dangerous:
             if self.extension_type == "applet":
                 self.add_status('dangerous', 'dialog-warning-symbolic', _("This applet contains function calls that could potentially cause Cinnamon to crash or freeze. If you are experiencing crashes or freezing, please try removing it."))
@@ -470,8 +580,8 @@ class ManageSpicesPage(SettingsPage):
 
         def sort_rows(row1, row2):
             if row1.writable == row2.writable:
-                name1 = row1.name.lower()
-                name2 = row2.name.lower()
+                name1 = row1.sort_name
+                name2 = row2.sort_name
                 if name1 < name2:
                     return -1
                 if name2 < name1:
@@ -561,8 +671,9 @@ class ManageSpicesPage(SettingsPage):
             self.has_filter = True
 
     def enabled_changed(self, *args):
+        enabled_map = self.spices.get_enabled_map()
         for row in self.extension_rows:
-            row.set_enabled(self.spices.get_enabled(row.uuid))
+            row.set_enabled(enabled_map.get(row.uuid, 0))
 
         self.update_button_states()
 
@@ -648,21 +759,23 @@ class ManageSpicesPage(SettingsPage):
         self.extension_rows = []
 
         size_groups = [Gtk.SizeGroup.new(Gtk.SizeGroupMode.HORIZONTAL) for i in range(3)]
+        enabled_map = self.spices.get_enabled_map()
 
         for uuid, metadata in self.spices.get_installed().items():
             try:
                 extension_row = ManageSpicesRow(self.collection_type, metadata, size_groups)
                 self.list_box.add(extension_row)
                 self.extension_rows.append(extension_row)
-                extension_row.set_enabled(self.spices.get_enabled(uuid))
+                extension_row.set_enabled(enabled_map.get(uuid, 0))
             except Exception as msg:
                 print(f"Failed to load extension {uuid}: {msg}")
 
         self.list_box.show_all()
 
     def update_status(self, *args):
+        enabled_map = self.spices.get_enabled_map()
         for row in self.extension_rows:
-            enabled = self.spices.get_enabled(row.uuid)
+            enabled = enabled_map.get(row.uuid, 0)
             row.set_enabled(enabled)
             if enabled and not self.spices.get_is_running(row.uuid) and self.collection_type != 'action':
                 row.add_status('error', 'dialog-error-symbolic', _("Something went wrong while loading %s. Please make sure you are using the latest version, and then report the issue to its developer.") % row.uuid)
@@ -675,13 +788,18 @@ class ManageSpicesPage(SettingsPage):
         self.search_entry.grab_focus()
 
 
-class DownloadSpicesRow(Gtk.ListBoxRow):
-    def __init__(self, uuid, data, spices, size_groups):
-        super().__init__()
+class SpiceItem(GObject.Object):
+    """ A single entry of the spices index, as held by the download page's model """
+    installed = GObject.Property(type=bool, default=False)
+    has_update = GObject.Property(type=bool, default=False)
 
+    def __init__(self, uuid, data):
+        super().__init__()
         self.uuid = uuid
+        self.update_data(data)
+
+    def update_data(self, data):
         self.data = data
-        self.spices = spices
         self.name = data['name']
         self.description = data['description']
         self.score = data['score']
@@ -704,11 +822,34 @@ class DownloadSpicesRow(Gtk.ListBoxRow):
                     self.description = data['translations'][key]
                     break
 
-        self.has_update = False
+        self.sort_name = self.name.lower()
+        self.search_text = make_search_text(self.name, self.description, self.uuid, self.author)
 
-        self.status_ids = {}
+    def update_state(self, spices):
+        """ refreshes the installed and update flags, returns True if either changed """
+        installed = spices.get_is_installed(self.uuid)
+        has_update = installed and spices.get_has_update(self.uuid)
+
+        changed = False
+        if installed != self.installed:
+            self.installed = installed
+            changed = True
+        if has_update != self.has_update:
+            self.has_update = has_update
+            changed = True
+
+        return changed
+
+
+class DownloadSpicesRow(Gtk.ListBoxRow):
+    def __init__(self, item, spices, size_groups):
+        super().__init__()
+
+        self.item = item
+        self.uuid = item.uuid
+        self.spices = spices
 
-        self.installed = self.spices.get_is_installed(uuid)
+        self.status_ids = {}
 
         widget = SettingsWidget()
         widget.set_spacing(15)
@@ -718,16 +859,12 @@ class DownloadSpicesRow(Gtk.ListBoxRow):
         installed_box.set_spacing(4)
         widget.pack_start(installed_box, False, False, 0)
         size_groups[0].add_widget(installed_box)
-        installed_image = Gtk.Image.new_from_icon_name('object-select-symbolic', 2)
-        installed_box.pack_end(installed_image, False, False, 0)
-        installed_image.set_tooltip_text(_("Installed"))
-        installed_image.set_no_show_all(True)
-        if self.installed:
-            installed_image.show()
-        else:
-            installed_image.hide()
+        self.installed_image = Gtk.Image.new_from_icon_name('object-select-symbolic', 2)
+        installed_box.pack_end(self.installed_image, False, False, 0)
+        self.installed_image.set_tooltip_text(_("Installed"))
+        self.installed_image.set_no_show_all(True)
 
-        icon = spices.get_icon(uuid)
+        icon = spices.get_icon(self.uuid)
         widget.pack_start(icon, False, False, 0)
 
         desc_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -736,11 +873,11 @@ class DownloadSpicesRow(Gtk.ListBoxRow):
         desc_box.set_spacing(1)
 
         name_label = Gtk.Label()
-        name_markup = GLib.markup_escape_text(self.name)
-        if self.author == "":
+        name_markup = GLib.markup_escape_text(item.name)
+        if item.author == "":
             name_label.set_markup(f'<b>{name_markup}</b>')
         else:
-            by_author = _("by %s") % self.author
+            by_author = _("by %s") % item.author
             name_label.set_markup(f'<b>{name_markup}</b><small> {by_author}</small>')
         name_label.set_hexpand(True)
         name_label.set_halign(Gtk.Align.START)
@@ -752,22 +889,16 @@ class DownloadSpicesRow(Gtk.ListBoxRow):
         uuid_label.props.xalign = 0.0
         desc_box.add(uuid_label)
 
-        description_label = SettingsLabel()
-        description_markup = GLib.markup_escape_text(sanitize_html(self.description))
-        if self.spices.get_has_update(uuid):
-            subject_markup = GLib.markup_escape_text(sanitize_html(self.subject))
-            description_label.set_markup(f'<small>{description_markup}</small>\n<small><i>{subject_markup}</i></small>')
-        else:
-            description_label.set_markup(f'<small>{description_markup}</small>')
-        description_label.set_margin_top(2)
-        desc_box.pack_start(description_label, False, False, 0)
+        self.description_label = SettingsLabel()
+        self.description_label.set_margin_top(2)
+        desc_box.pack_start(self.description_label, False, False, 0)
 
         widget.pack_start(desc_box, True, True, 0)
 
         score_box = Gtk.Box()
         score_image = Gtk.Image.new_from_icon_name('starred-symbolic', 2)
         score_box.pack_start(score_image, False, False, 0)
-        score_label = Gtk.Label(self.score)
+        score_label = Gtk.Label(item.score)
         score_box.pack_start(score_label, False, False, 5)
         widget.pack_start(score_box, False, False, 0)
         size_groups[1].add_widget(score_box)
@@ -783,17 +914,47 @@ class DownloadSpicesRow(Gtk.ListBoxRow):
         widget.pack_start(self.button_box, False, False, 0)
         size_groups[3].add_widget(self.button_box)
 
-        if not self.installed:
+        self.update_state()
+
+        self.notify_ids = [
+            item.connect('notify::installed', self.update_state),
+            item.connect('notify::has-update', self.update_state)
+        ]
+        self.connect('destroy', self.on_destroy)
+
+    def update_state(self, *args):
+        if self.item.installed:
+            self.installed_image.show()
+        else:
+            self.installed_image.hide()
+
+        description_markup = GLib.markup_escape_text(sanitize_html(self.item.description))
+        if self.item.has_update:
+            subject_markup = GLib.markup_escape_text(sanitize_html(self.item.subject))
+            self.description_label.set_markup(f'<small>{description_markup}</small>\n<small><i>{subject_markup}</i></small>')
+        else:
+            self.description_label.set_markup(f'<small>{description_markup}</small>')
+
+        for child in self.button_box.get_children():
+            child.destroy()
+
+        if not self.item.installed:
             download_button = Gtk.Button.new_from_icon_name('folder-download-symbolic', 2)
             self.button_box.pack_start(download_button, False, False, 0)
             download_button.connect('clicked', self.download)
             download_button.set_tooltip_text(_("Install"))
-        elif self.spices.get_has_update(uuid):
-            self.has_update = True
+            download_button.show()
+        elif self.item.has_update:
             download_button = Gtk.Button.new_from_icon_name('view-refresh-symbolic', 2)
             self.button_box.pack_start(download_button, False, False, 0)
             download_button.connect('clicked', self.download)
             download_button.set_tooltip_text(_("Update"))
+            download_button.show()
+
+    def on_destroy(self, *args):
+        for notify_id in self.notify_ids:
+            self.item.disconnect(notify_id)
+        self.notify_ids = []
 
     def download(self, *args):
         self.spices.install(self.uuid)
@@ -826,8 +987,10 @@ class DownloadSpicesPage(SettingsPage):
         self.collection_type = collection_type
         self.spices = spices
         self.window = window
-        self.has_filter = False
-        self.extension_rows = []
+        self.items = {}
+        self.visible_items = []
+        self.n_shown = 0
+        self.search_index = None
         self._signals = []
 
         self.initial_refresh_done = False
@@ -882,9 +1045,20 @@ class DownloadSpicesPage(SettingsPage):
         self.box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         scw.add(self.box)
 
+        # Only a window of the sorted and filtered items is put in the model,
+        # more get added as the list is scrolled towards the end.
+        self.vadjustment = scw.get_vadjustment()
+        self.vadjustment.connect('value-changed', self.on_scrolled)
+        self.vadjustment.connect('changed', self.on_scrolled)
+
+        self.size_groups = [Gtk.SizeGroup.new(Gtk.SizeGroupMode.HORIZONTAL) for i in range(4)]
+
+        self.model = Gio.ListStore(item_type=SpiceItem)
+
         self.list_box = Gtk.ListBox()
         self.list_box.set_selection_mode(Gtk.SelectionMode.SINGLE)
         self.list_box.set_header_func(list_header_func, None)
+        self.list_box.bind_model(self.model, self.create_row)
         self.list_box.connect('row-selected', self.on_row_selected)
         self.box.add(self.list_box)
 
@@ -942,61 +1116,57 @@ class DownloadSpicesPage(SettingsPage):
         self.connect('map', self.on_page_map)
 
         self.spices.connect('cache-loaded', self.build_list)
-        self.spices.connect('installed-changed', self.build_list)
+        self.spices.connect('installed-changed', self.update_installed)
 
-    def on_entry_refilter(self, widget, data=None):
-        if self.search_entry.get_text() == '':
-            self.list_box.set_filter_func(None)
-            self.has_filter = False
-            return
+    def create_row(self, item):
+        row = DownloadSpicesRow(item, self.spices, self.size_groups)
+        row.show_all()
+        return row
 
-        if self.has_filter:
-            self.list_box.invalidate_filter()
-        else:
-            self.list_box.set_filter_func(filter_row, self.search_entry)
-            self.has_filter = True
+    def on_entry_refilter(self, widget, data=None):
+        self.update_view()
 
     def sort_changed(self, *args):
-        def sort_name(row1, row2):
-            if row2.name.lower() == row1.name.lower():
-                return 0
-            if row2.name.lower() < row1.name.lower():
-                return 1
-            return -1
-
-        def sort_score(row1, row2):
-            return row2.score - row1.score
-
-        def sort_date(row1, row2):
-            return row2.timestamp - row1.timestamp
-
-        def sort_installed(row1, row2):
-            if row1.installed == row2.installed:
-                return 0
-            if row1.installed:
-                return -1
-            return 1
-
-        def sort_update(row1, row2):
-            if row1.has_update == row2.has_update:
-                if not row1.has_update:
-                    return row2.timestamp - row1.timestamp
-                return 0
-            if row1.has_update:
-                return -1
-            return 1
+        self.search_index = None
+        self.update_view()
 
+    def get_sort_key(self):
         sort_type = self.spices_sort_combo.get_active_id()
         if sort_type == 'name':
-            self.list_box.set_sort_func(sort_name)
+            return lambda item: item.sort_name
         elif sort_type == 'score':
-            self.list_box.set_sort_func(sort_score)
+            return lambda item: -item.score
         elif sort_type == 'date':
-            self.list_box.set_sort_func(sort_date)
+            return lambda item: -item.timestamp
         elif sort_type == 'installed':
-            self.list_box.set_sort_func(sort_installed)
+            return lambda item: not item.installed
         else:
-            self.list_box.set_sort_func(sort_update)
+            return lambda item: (not item.has_update, 0 if item.has_update else -item.timestamp)
+
+    def update_view(self):
+        """ re-filters the items, and resets the model to the first page of them """
+        # The index holds the items in the current sort order, it only needs
+        # rebuilding when the items or the order change.
+        if self.search_index is None:
+            self.search_index = SearchIndex(sorted(self.items.values(), key=self.get_sort_key()))
+
+        self.visible_items = self.search_index.search(self.search_entry.get_text())
+
+        self.n_shown = min(len(self.visible_items), DOWNLOAD_PAGE_SIZE)
+        self.model.splice(0, self.model.get_n_items(), self.visible_items[:self.n_shown])
+
+    def on_scrolled(self, adjustment):
+        if self.n_shown >= len(self.visible_items) or adjustment.get_page_size() == 0:
+            return
+
+        # Load the next batch when within a screen of the end, or if the
+        # current batch doesn't fill the view.
+        if adjustment.get_value() + 2 * adjustment.get_page_size() < adjustment.get_upper():
+            return
+
+        n_shown = min(len(self.visible_items), self.n_shown + DOWNLOAD_PAGE_SIZE)
+        self.model.splice(self.n_shown, 0, self.visible_items[self.n_shown:n_shown])
+        self.n_shown = n_shown
 
     def on_row_selected(self, list_box, row):
         if row is None:
@@ -1004,7 +1174,7 @@ class DownloadSpicesPage(SettingsPage):
             self.uninstall_button.set_sensitive(False)
         else:
             self.more_info_button.set_sensitive(True)
-            self.uninstall_button.set_sensitive(row.installed)
+            self.uninstall_button.set_sensitive(row.item.installed)
 
     def uninstall(self, *args):
         extension_row = self.list_box.get_selected_row()
@@ -1023,18 +1193,36 @@ class DownloadSpicesPage(SettingsPage):
         if spices_data is None:
             return
 
-        if len(self.extension_rows) > 0:
-            for row in self.extension_rows:
-                row.destroy()
-            self.extension_rows = []
-
-        size_groups = [Gtk.SizeGroup.new(Gtk.SizeGroupMode.HORIZONTAL) for i in range(4)]
-
+        items = {}
         for uuid, data in spices_data.items():
-            row = DownloadSpicesRow(uuid, data, self.spices, size_groups)
-            self.extension_rows.append(row)
-            self.list_box.add(row)
-
+            item = self.items.get(uuid)
+            if item is None:
+                item = SpiceItem(uuid, data)
+            elif item.data is not data:
+                item.update_data(data)
+            item.update_state(self.spices)
+            items[uuid] = item
+
+        self.items = items
+        self.search_index = None
+        self.update_view()
+        self.update_buttons()
+
+    def update_installed(self, *args):
+        changed = False
+        for item in self.items.values():
+            if item.update_state(self.spices):
+                changed = True
+
+        # Rows update themselves, the order only depends on the installed
+        # state for these two.
+        if changed and self.spices_sort_combo.get_active_id() in ('installed', 'update'):
+            self.search_index = None
+            self.update_view()
+
+        self.update_buttons()
+
+    def update_buttons(self):
         updates_available = self.spices.get_n_updates()
         self.update_all_button.set_sensitive(updates_available)
         if updates_available > 0:
@@ -1043,7 +1231,6 @@ class DownloadSpicesPage(SettingsPage):
             msg_text = _("No updates available")
         self.update_all_button.set_tooltip_text(msg_text)
         self.refresh_button.set_sensitive(True)
-        self.list_box.show_all()
 
     def get_more_info(self, *args):
         extension_row = self.list_box.get_selected_row()
@@ -1056,7 +1243,7 @@ class DownloadSpicesPage(SettingsPage):
         GLib.idle_add(self.on_page_shown)
 
     def on_page_shown(self, *args):
-        if not self.extension_rows:
+        if not self.items:
             self.build_list()
 
         if not self.initial_refresh_done and not self.spices.processing_jobs:
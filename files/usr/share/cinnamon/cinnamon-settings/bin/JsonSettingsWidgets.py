@@ -1,15 +1,19 @@
 #!/usr/bin/python3
 
-from gi.repository import Gio
+from gi.repository import Gio, GLib
 from xapp.SettingsWidgets import *
 from SettingsWidgets import SoundFileChooser, DateChooser, TimeChooser, Keybinding
 from xapp.GSettingsWidgets import CAN_BACKEND as px_can_backend
 from SettingsWidgets import CAN_BACKEND as c_can_backend
 from TreeListWidgets import List
+import fileutil
 import os
 import collections
+import copy
+import hashlib
 import json
 import operator
+import threading
 
 can_backend = px_can_backend + c_can_backend
 can_backend.append('List')
@@ -40,17 +44,41 @@ OPERATIONS = ['<=', '>=', '<', '>', '!=', '=']
 
 OPERATIONS_MAP = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '!=': operator.ne, '=': operator.eq}
 
+# Changes are written out once no other change has come in for this long (ms)
+SAVE_DELAY = 500
+
 class JSONSettingsHandler(object):
-    def __init__(self, filepath, notify_callback=None):
+    def __init__(self, filepath, notify_callback=None, monitor=True):
         super(JSONSettingsHandler, self).__init__()
 
-        self.resume_timeout = None
         self.notify_callback = notify_callback
 
+        # Writes are coalesced and done from a thread. The generation makes
+        # sure an older write can never land after a newer one, and the hash
+        # of the file as we last saw or wrote it lets check_settings() skip
+        # our own changes and repeated monitor events.
+        self.save_timeout = None
+        self.save_again = False
+        self.writing = False
+        self.write_lock = threading.Lock()
+        self.generation = 0
+        self.written_generation = 0
+        self.saved_generation = 0
+        self.file_hash = None
+        # key -> generation of the write which will carry its latest change
+        self.pending_keys = {}
+        # (key, value, generation) of the last change Cinnamon hasn't been told
+        # about. It reads the whole file when told, so that waits for the write.
+        self.unnotified = None
+
         self.filepath = filepath
         self.file_obj = Gio.File.new_for_path(self.filepath)
-        self.file_monitor = self.file_obj.monitor_file(Gio.FileMonitorFlags.SEND_MOVED, None)
-        self.file_monitor.connect("changed", self.check_settings)
+        # without a monitor of its own, the owner is expected to call
+        # check_settings() whenever the file changes
+        self.file_monitor = None
+        if monitor:
+            self.file_monitor = self.file_obj.monitor_file(Gio.FileMonitorFlags.SEND_MOVED, None)
+            self.file_monitor.connect("changed", self.check_settings)
 
         self.bindings = {}
         self.listeners = {}
@@ -83,9 +111,9 @@ class JSONSettingsHandler(object):
     def set_value(self, key, value):
         if value != self.settings[key]["value"]:
             self.settings[key]["value"] = value
-            self.save_settings()
-            if self.notify_callback:
-                self.notify_callback(self, key, value)
+            self.pending_keys[key] = self.generation + 1
+            self.unnotified = (key, value, self.generation + 1)
+            self.queue_save()
 
             if key in self.bindings:
                 for info in self.bindings[key]:
@@ -132,91 +160,225 @@ class JSONSettingsHandler(object):
                 info["obj"].set_property(info["prop"], value)
 
     def check_settings(self, *args):
+        try:
+            raw_data = self.read_settings_file(self.filepath)
+        except OSError:
+            return
+
+        # Our own writes, and the several events a single write can cause,
+        # leave the file as we already know it.
+        file_hash = self.hash_settings(raw_data)
+        if file_hash == self.file_hash:
+            return
+        self.file_hash = file_hash
+
+        try:
+            new_settings = self.parse_settings(raw_data)
+        except Exception as e:
+            # most likely caught halfway through a non-atomic write, we'll
+            # get another event once it's done
+            print(e)
+            return
+
         old_settings = self.settings
-        self.settings = self.get_settings()
+        self.settings = new_settings
 
-        for key in self.bindings:
-            new_value = self.settings[key]["value"]
-            if new_value != old_settings[key]["value"]:
-                for info in self.bindings[key]:
-                    self.set_object_value(info, new_value)
+        # Changes made here that haven't been written yet win over the file
+        for key in self.pending_keys:
+            if key in self.settings and key in old_settings:
+                self.settings[key]["value"] = old_settings[key]["value"]
+
+        changed = self.diff_settings(old_settings, self.settings)
+        if not changed:
+            return
 
-        for key, callback_list in self.listeners.items():
-            new_value = self.settings[key]["value"]
-            if new_value != old_settings[key]["value"]:
-                for callback in callback_list:
-                    callback(key, new_value)
+        self.do_keys_update(changed)
 
-    def get_settings(self):
-        file = open(self.filepath)
-        raw_data = file.read()
-        file.close()
+    def diff_settings(self, old_settings, new_settings):
+        """ returns the keys whose value differs between the two, with their new value """
+        changed = collections.OrderedDict()
+        for key, props in new_settings.items():
+            if not isinstance(props, dict) or "value" not in props:
+                continue
+            old_props = old_settings.get(key)
+            if old_props is None or "value" not in old_props:
+                continue
+            if props["value"] != old_props["value"]:
+                changed[key] = props["value"]
+        return changed
+
+    def hash_settings(self, raw_data):
+        return hashlib.sha1(raw_data.encode("utf-8")).digest()
+
+    def read_settings_file(self, filepath):
+        with open(filepath, encoding="utf-8") as file:
+            return file.read()
+
+    def parse_settings(self, raw_data):
         try:
             settings = json.loads(raw_data, object_pairs_hook=collections.OrderedDict)
         except:
             raise Exception("Failed to parse settings JSON data for file %s" % self.filepath)
         return settings
 
-    def save_settings(self):
-        self.pause_monitor()
-        if os.path.exists(self.filepath):
-            os.remove(self.filepath)
+    def get_settings(self):
+        raw_data = self.read_settings_file(self.filepath)
+        self.file_hash = self.hash_settings(raw_data)
+        return self.parse_settings(raw_data)
+
+    def queue_save(self):
+        if self.save_timeout:
+            GLib.source_remove(self.save_timeout)
+        self.save_timeout = GLib.timeout_add(SAVE_DELAY, self.do_queued_save)
+
+    def do_queued_save(self):
+        self.save_timeout = None
+
+        if self.writing:
+            # picked up again once the current write is done
+            self.save_again = True
+            return False
+
         raw_data = json.dumps(self.settings, indent=4, ensure_ascii=False)
-        new_file = open(self.filepath, 'w+')
-        new_file.write(raw_data)
-        new_file.close()
-        self.resume_monitor()
+        self.generation += 1
+        self.writing = True
+
+        thread = threading.Thread(target=self.write_thread, args=(raw_data, self.generation))
+        thread.start()
+        return False
 
-    def pause_monitor(self):
-        self.file_monitor.cancel()
-        self.handler = None
+    def write_thread(self, raw_data, generation):
+        file_hash = None
+        try:
+            file_hash = self.write_settings_file(raw_data, generation)
+        except OSError as e:
+            print("Failed to save settings to %s: %s" % (self.filepath, e))
 
-    def resume_monitor(self):
-        if self.resume_timeout:
-            GLib.source_remove(self.resume_timeout)
-        self.resume_timeout = GLib.timeout_add(2000, self.do_resume)
+        GLib.idle_add(self.on_write_done, generation, file_hash)
 
-    def do_resume(self):
-        self.file_monitor = self.file_obj.monitor_file(Gio.FileMonitorFlags.SEND_MOVED, None)
-        self.handler = self.file_monitor.connect("changed", self.check_settings)
-        self.resume_timeout = None
+    def on_write_done(self, generation, file_hash):
+        self.writing = False
+        if file_hash is not None:
+            self.write_done(generation, file_hash)
+
+        if self.save_again:
+            self.save_again = False
+            self.do_queued_save()
         return False
 
-    def reset_to_defaults(self):
-        for key in self.settings:
-            if "value" in self.settings[key]:
-                self.settings[key]["value"] = self.settings[key]["default"]
-                self.do_key_update(key)
+    def write_done(self, generation, file_hash):
+        """ called on the main thread once the given generation is on disk """
+        if generation > self.saved_generation:
+            self.saved_generation = generation
+            self.file_hash = file_hash
+            # keys changed again since then are still waiting for a later write
+            self.pending_keys = {key: key_generation for key, key_generation in self.pending_keys.items()
+                                 if key_generation > generation}
+
+        if self.unnotified is None or self.unnotified[2] > generation:
+            return
+
+        key, value, change_generation = self.unnotified
+        self.unnotified = None
+        if self.notify_callback:
+            self.notify_callback(self, key, value)
+
+    def write_settings_file(self, raw_data, generation):
+        """ returns the hash of the new file, or None if a newer generation
+            was written already """
+        with self.write_lock:
+            if generation < self.written_generation:
+                return None
+
+            self.written_generation = generation
+            fileutil.write_file_atomically(self.filepath, raw_data)
+            return self.hash_settings(raw_data)
+
+    def save_settings(self):
+        """ writes the settings out right away, including any queued changes """
+        if self.save_timeout:
+            GLib.source_remove(self.save_timeout)
+            self.save_timeout = None
+
+        raw_data = json.dumps(self.settings, indent=4, ensure_ascii=False)
+        self.generation += 1
+        file_hash = self.write_settings_file(raw_data, self.generation)
+        if file_hash is not None:
+            self.write_done(self.generation, file_hash)
+
+    def flush(self):
+        """ writes out any changes still waiting to be saved or being written """
+        if self.save_timeout or self.save_again or self.unnotified is not None:
+            self.save_again = False
+            self.save_settings()
+
+    def apply_values(self, values):
+        """ sets the values of several keys at once: the document is swapped in one
+            step, written once, and listeners get a single set of changes """
+        new_settings = copy.deepcopy(self.settings)
+        for key, value in values.items():
+            if key in new_settings and "value" in new_settings[key]:
+                new_settings[key]["value"] = value
+
+        changed = self.diff_settings(self.settings, new_settings)
+        if not changed:
+            return
 
+        # the notification makes the other side reload the whole file, so
+        # one for the last key covers all of them
+        key, value = next(reversed(changed.items()))
+        self.unnotified = (key, value, self.generation + 1)
+
+        # refresh the widgets first, then write the file and send the single
+        # notification once everything is in place
+        self.settings = new_settings
+        self.do_keys_update(changed)
         self.save_settings()
 
-    def do_key_update(self, key):
-        if key in self.bindings:
-            for info in self.bindings[key]:
-                self.set_object_value(info, self.settings[key]["value"])
+    def reset_to_defaults(self):
+        values = {}
+        for key in self.settings:
+            if "value" in self.settings[key] and "default" in self.settings[key]:
+                values[key] = self.settings[key]["default"]
+
+        self.apply_values(values)
+
+    def do_keys_update(self, keys):
+        """ refreshes the widgets and listeners of several keys in one pass. The new values
+            are already in self.settings, so the widgets' notify handlers are blocked
+            rather than each change bouncing back through object_value_changed """
+        blocked = []
+        for key in keys:
+            for info in self.bindings.get(key, []):
+                if "oid" in info:
+                    info["obj"].handler_block(info["oid"])
+                    blocked.append(info)
 
-        if key in self.listeners:
-            for callback in self.listeners[key]:
+        try:
+            for key in keys:
+                for info in self.bindings.get(key, []):
+                    self.set_object_value(info, self.settings[key]["value"])
+        finally:
+            for info in blocked:
+                info["obj"].handler_unblock(info["oid"])
+
+        for key in keys:
+            for callback in self.listeners.get(key, []):
                 callback(key, self.settings[key]["value"])
 
     def load_from_file(self, filepath):
-        file = open(filepath)
-        raw_data = file.read()
-        file.close()
-        try:
-            settings = json.loads(raw_data, object_pairs_hook=collections.OrderedDict)
-        except:
-            raise Exception("Failed to parse settings JSON data for file %s" % self.filepath)
+        settings = self.parse_settings(self.read_settings_file(filepath))
 
+        values = {}
         for key in self.settings:
             if "value" not in self.settings[key]:
                 continue
-            if key in settings and "value" in self.settings[key]:
-                self.settings[key]["value"] = settings[key]["value"]
-                self.do_key_update(key)
+            if key in settings and "value" in settings[key]:
+                values[key] = settings[key]["value"]
             else:
                 print("Skipping key %s: the key does not exist in %s or has no value" % (key, filepath))
-        self.save_settings()
+
+        self.apply_values(values)
 
     def save_to_file(self, filepath):
         if os.path.exists(filepath):
@@ -312,23 +474,33 @@ class JSONSettingsBackend(object):
         if self.bind_dir is None:
             raise NotImplementedError("SettingsWidget classes with no .bind_dir must implement connect_widget_handlers().")
 
+# widget classes made by json_settings_factory(), by subclass name
+json_settings_classes = {}
+
+def json_settings_kwargs(properties):
+    kwargs = {}
+    for prop in properties:
+        if prop in JSON_SETTINGS_PROPERTIES_MAP:
+            kwargs[JSON_SETTINGS_PROPERTIES_MAP[prop]] = properties[prop]
+        elif prop == "options":
+            kwargs["options"] = []
+            for value, label in properties[prop].items():
+                kwargs["options"].append((label, value))
+    return kwargs
+
 def json_settings_factory(subclass):
+    if subclass in json_settings_classes:
+        return json_settings_classes[subclass]
+
     class NewClass(globals()[subclass], JSONSettingsBackend):
         def __init__(self, key, settings, properties):
             self.key = key
             self.settings = settings
 
-            kwargs = {}
-            for prop in properties:
-                if prop in JSON_SETTINGS_PROPERTIES_MAP:
-                    kwargs[JSON_SETTINGS_PROPERTIES_MAP[prop]] = properties[prop]
-                elif prop == "options":
-                    kwargs["options"] = []
-                    for value, label in properties[prop].items():
-                        kwargs["options"].append((label, value))
-            super(NewClass, self).__init__(**kwargs)
+            super(NewClass, self).__init__(**json_settings_kwargs(properties))
             self.attach()
 
+    json_settings_classes[subclass] = NewClass
     return NewClass
 
 for widget in can_backend:
@@ -169,6 +169,11 @@ class Spice_Harvester(GObject.Object):
             self.settings = Gio.Settings.new('org.cinnamon')
             self.enabled_key = f'enabled-{self.collection_type}s'
 
+        # uuid -> number of enabled instances, rebuilt on demand after the
+        # enabled key changes
+        self._enabled_map = None
+        self.settings.connect(f'changed::{self.enabled_key}', self._invalidate_enabled_map)
+
         if not self.themes:
             self.settings.connect(f'changed::{self.enabled_key}', self._update_status)
 
@@ -512,6 +517,7 @@ class Spice_Harvester(GObject.Object):
 
     def _directory_changed(self, *args):
         self._load_metadata()
+        self._invalidate_enabled_map()
         self._generate_update_list()
         self.emit("installed-changed")
 
@@ -533,24 +539,37 @@ class Spice_Harvester(GObject.Object):
         except Exception:
             return False
 
-    def get_enabled(self, uuid):
-        """ returns the number of instances currently enabled"""
-        enabled_count = 0
+    def _invalidate_enabled_map(self, *args):
+        self._enabled_map = None
+
+    def get_enabled_map(self):
+        """ returns a dictionary of the number of instances currently enabled, by uuid. Spices
+            that aren't enabled may be missing from it"""
+        if self._enabled_map is not None:
+            return self._enabled_map
+
+        enabled_map = {}
         if not self.themes and not self.actions:
-            enabled_list = self.settings.get_strv(self.enabled_key)
-            for item in enabled_list:
-                item = item.replace("!", "")
-                if uuid in item.split(":"):
-                    enabled_count += 1
+            for item in self.settings.get_strv(self.enabled_key):
+                for part in set(item.replace("!", "").split(":")):
+                    enabled_map[part] = enabled_map.get(part, 0) + 1
         elif self.actions:
             disabled_list = self.settings.get_strv(self.enabled_key)
-            uuid_name = f"{uuid}.nemo_action"
-            if uuid_name not in disabled_list:
-                enabled_count = 1
-        elif self.settings.get_string(self.enabled_key) == uuid:
-            enabled_count = 1
+            for uuid in self.meta_map:
+                if f"{uuid}.nemo_action" not in disabled_list:
+                    enabled_map[uuid] = 1
+        else:
+            enabled_map[self.settings.get_string(self.enabled_key)] = 1
+
+        self._enabled_map = enabled_map
+        return enabled_map
+
+    def get_enabled(self, uuid):
+        """ returns the number of instances currently enabled"""
+        if self.actions and uuid not in self.meta_map:
+            return 0 if f"{uuid}.nemo_action" in self.settings.get_strv(self.enabled_key) else 1
 
-        return enabled_count
+        return self.get_enabled_map().get(uuid, 0)
 
     def get_is_running(self, uuid):
         """ checks whether the spice is currently running (it may be enabled but not running if
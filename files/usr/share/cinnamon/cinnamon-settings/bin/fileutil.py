@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+# Kept free of gi imports, so that scripts which only need to save a file, like
+# cinnamon-startup-profiler at login, can use it cheaply.
+
+import os
+import json
+import tempfile
+
+def write_file_atomically(path, data, mode=None):
+    """ writes data (str or bytes) to a temporary file next to path and moves it in
+        place, so that anyone reading the file never sees it missing or half written.
+        The file keeps its permissions unless a mode is given. """
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+
+    dirname, basename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".%s." % basename)
+    try:
+        if isinstance(data, bytes):
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+        else:
+            with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+                tmp_file.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def save_cache_file(path, data):
+    """ saves data as json, creating the cache folder if needed """
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+    write_file_atomically(path, json.dumps(data))
@@ -10,11 +10,12 @@ from html import escape
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gdk, Gio, Gtk
+from gi.repository import Gdk, Gio, GLib, Gtk
 
 from KeybindingWidgets import ButtonKeybinding, CellRendererKeybinding
 from SettingsWidgets import SidePage
 from bin import util
+from bin import fileutil
 from xapp.GSettingsWidgets import *
 
 gettext.install("cinnamon", "/usr/share/locale")
@@ -32,6 +33,7 @@ ENABLED_SCHEMA = "org.cinnamon"
 
 OLD_SETTINGS_DIR = Path.joinpath(Path.home(), ".cinnamon/configs/")
 SETTINGS_DIR = Path.joinpath(Path.home(), ".config/cinnamon/spices/")
+KEYBINDING_CACHE_FILE = os.path.join(GLib.get_user_cache_dir(), "cinnamon", "spice-keybindings.json")
 
 MASKS = [Gdk.ModifierType.CONTROL_MASK, Gdk.ModifierType.MOD1_MASK,
          Gdk.ModifierType.SHIFT_MASK, Gdk.ModifierType.SUPER_MASK]
@@ -225,12 +227,195 @@ KEYBINDINGS = [
 # Use a dummy entry to trigger this by alternately adding and removing it to the list.
 DUMMY_CUSTOM_ENTRY = "__dummy__"
 
+# Gio.Settings objects for the keybinding schemas, shared by all the bindings using one
+SCHEMA_SETTINGS = {}
+
+def getSchemaSettings(schema):
+    if schema not in SCHEMA_SETTINGS:
+        SCHEMA_SETTINGS[schema] = Gio.Settings.new(schema)
+    return SCHEMA_SETTINGS[schema]
+
 def ensureCustomListChanges(custom_list):
     if DUMMY_CUSTOM_ENTRY in custom_list:
         custom_list.remove(DUMMY_CUSTOM_ENTRY)
     else:
         custom_list.append(DUMMY_CUSTOM_ENTRY)
 
+class SpiceKeybindingCatalogue:
+    """ remembers the keybindings found in spice config files and the names in their
+        metadata, so that only files which changed since last time are read again """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.seen = set()
+        self.changed = False
+
+        try:
+            with open(self.cache_file, encoding="utf-8") as cache:
+                self.cache = json.load(cache)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def lookup(self, path, read_func):
+        path = str(path)
+        self.seen.add(path)
+
+        stat = os.stat(path)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        entry = self.cache.get(path)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["data"]
+
+        data = read_func(path)
+        self.cache[path] = {"stamp": stamp, "data": data}
+        self.changed = True
+        return data
+
+    def get_keybindings(self, config_path):
+        """ returns {key: [description, value]} for the keybindings in a config file """
+        return self.lookup(config_path, self.read_keybindings)
+
+    def get_name(self, metadata_path):
+        return self.lookup(metadata_path, self.read_name)
+
+    def read_keybindings(self, path):
+        with open(path, "rb") as config_file:
+            raw_data = config_file.read()
+
+        # most configs don't have any keybindings, no need to parse those
+        if b'"keybinding"' not in raw_data:
+            return {}
+
+        keybindings = {}
+        for key, val in json.loads(raw_data).items():
+            if isinstance(val, dict) and val.get("type") == "keybinding":
+                keybindings[key] = [val.get("description"), val.get("value")]
+        return keybindings
+
+    def read_name(self, path):
+        with open(path, encoding="utf-8") as metadata:
+            return json.load(metadata).get("name")
+
+    def save(self):
+        # forget about files that are gone
+        for path in list(self.cache):
+            if path not in self.seen:
+                del self.cache[path]
+                self.changed = True
+
+        if not self.changed:
+            return
+
+        try:
+            fileutil.save_cache_file(self.cache_file, self.cache)
+            self.changed = False
+        except OSError as e:
+            print(f"Could not save the spice keybinding cache: {e}")
+
+class SpiceConfigWriter:
+    """ collects changes to spice keybinding values and writes each config file
+        once, atomically, when the main loop is idle """
+    def __init__(self):
+        self.pending = {}
+        self.idle_id = 0
+
+    def queue(self, path, key, value):
+        self.pending.setdefault(path, {})[key] = value
+        if self.idle_id == 0:
+            self.idle_id = GLib.idle_add(self.flush)
+
+    def get_pending(self, path, key):
+        return self.pending.get(path, {}).get(key)
+
+    def flush(self):
+        self.idle_id = 0
+        pending = self.pending
+        self.pending = {}
+
+        for path, values in pending.items():
+            try:
+                self.write(path, values)
+            except (OSError, ValueError) as e:
+                print(f"Could not save keybindings to {path}: {e}")
+
+        return False
+
+    def write(self, path, values):
+        with open(path, encoding="utf-8") as config_file:
+            config = json.load(config_file)
+
+        for key, value in values.items():
+            config[key]["value"] = value
+
+        # Replace the file in one go, so that Cinnamon never reads it truncated
+        fileutil.write_file_atomically(path, json.dumps(config, indent=4))
+
+spice_config_writer = SpiceConfigWriter()
+
+class AcceleratorIndex:
+    """ maps parsed accelerators to the keybindings using them """
+    def __init__(self):
+        self.bindings = {}
+        self.keys = {}
+        self.parsed = {}
+
+    def parse(self, accel_string):
+        if not accel_string or accel_string == "_invalid_":
+            return None
+
+        if accel_string not in self.parsed:
+            key, codes, mods = Gtk.accelerator_parse_with_keycode(accel_string)
+            if key == 0 and not codes:
+                self.parsed[accel_string] = None
+            else:
+                self.parsed[accel_string] = (key, tuple(codes) if codes else (), int(mods))
+
+        return self.parsed[accel_string]
+
+    def add(self, keybinding):
+        keys = set()
+        for entry in keybinding.entries:
+            parsed = self.parse(entry)
+            if parsed is not None:
+                keys.add(parsed)
+
+        self.keys[keybinding] = keys
+        for parsed in keys:
+            self.bindings.setdefault(parsed, []).append(keybinding)
+
+    def remove(self, keybinding):
+        for parsed in self.keys.pop(keybinding, ()):
+            users = self.bindings[parsed]
+            users.remove(keybinding)
+            if not users:
+                del self.bindings[parsed]
+
+    def update(self, keybinding):
+        self.remove(keybinding)
+        self.add(keybinding)
+
+    def find(self, accel_string):
+        return list(self.bindings.get(self.parse(accel_string), []))
+
+    def find_entries(self, keybinding, accel_string):
+        parsed = self.parse(accel_string)
+        return [index for index, entry in enumerate(keybinding.entries) if parsed is not None and self.parse(entry) == parsed]
+
+    def uses(self, keybinding, accel_string):
+        return self.parse(accel_string) in self.keys.get(keybinding, ())
+
+    def get_conflicts(self):
+        conflicts = []
+        for parsed, users in self.bindings.items():
+            if len(users) > 1:
+                key, codes, mods = parsed
+                if codes:
+                    label = Gtk.accelerator_get_label_with_keycode(None, key, codes[0], Gdk.ModifierType(mods))
+                else:
+                    label = Gtk.accelerator_get_label(key, Gdk.ModifierType(mods))
+                conflicts.append((label, users))
+
+        return sorted(conflicts, key=lambda conflict: conflict[0].lower())
+
 class Module:
     comment = _("Manage keyboard settings and shortcuts")
     name = "keyboard"
@@ -246,6 +431,9 @@ class Module:
         self.loaded = False
         self.binding_categories = {}
         self.main_store = []
+        self.categories = {}
+        # built the first time it's needed, see getAccelIndex()
+        self.accel_index = None
         self.cat_store = None
         self.kb_root_store = None
         self.kb_store = None
@@ -412,8 +600,11 @@ class Module:
             self.remove_custom_button = Gtk.Button.new_with_label(_("Remove custom shortcut"))
             self.remove_custom_button.connect('clicked', self.onRemoveCustomButtonClicked)
             self.remove_custom_button.set_property('sensitive', False)
+            self.conflicts_button = Gtk.Button.new_with_label(_("Show conflicts"))
+            self.conflicts_button.connect('clicked', self.onShowConflictsButtonClicked)
             buttonbox.pack_start(self.add_custom_button, False, False, 2)
             buttonbox.pack_start(self.remove_custom_button, False, False, 2)
+            buttonbox.pack_start(self.conflicts_button, False, False, 2)
 
             right_vbox.pack_end(buttonbox, False, False, 2)
 
@@ -495,6 +686,7 @@ class Module:
             keyboard_spices = sorted(enabled_spices)
             spice_keybinds = {}
             spice_properties = {}
+            catalogue = SpiceKeybindingCatalogue(KEYBINDING_CACHE_FILE)
 
             for spice, _type in keyboard_spices:
                 for settings_dir in (OLD_SETTINGS_DIR, SETTINGS_DIR):
@@ -509,37 +701,37 @@ class Module:
                             config_json = Path.joinpath(config_path, config)
                             _id = config.split(".json")[0]
                             key_name = f"{spice} {_id}" if _id.isdigit() else spice
-                            with open(config_json, encoding="utf-8") as config_file:
-                                _config = json.load(config_file)
-
-                                for key, val in _config.items():
-                                    if isinstance(val, dict) and val.get("type") == "keybinding":
-                                        spice_properties.setdefault(key_name, {})
-                                        spice_properties[key_name]["highlight"] = spice not in enabled_extensions
-                                        spice_properties[key_name]["path"] = str(config_json)
-                                        spice_properties[key_name]["type"] = _type
-                                        spice_keybinds.setdefault(key_name, {})
-                                        spice_keybinds[key_name].setdefault(key, {})
-                                        spice_keybinds[key_name][key] = {val.get("description"): val.get("value").split("::")}
-
+                            try:
+                                keybindings = catalogue.get_keybindings(config_json)
+                            except (OSError, ValueError) as e:
+                                print(f"Could not read {config_json}: {e}")
+                                continue
+
+                            for key, (description, value) in keybindings.items():
+                                spice_properties.setdefault(key_name, {})
+                                spice_properties[key_name]["highlight"] = spice not in enabled_extensions
+                                spice_properties[key_name]["path"] = str(config_json)
+                                spice_properties[key_name]["type"] = _type
+                                spice_keybinds.setdefault(key_name, {})
+                                spice_keybinds[key_name][key] = {description: value.split("::")}
+
+            text_domains = set()
             for spice, bindings in spice_keybinds.items():
                 name, *_id = spice.split()
 
                 properties = {spice: spice_properties[spice]}
                 _type = spice_properties[spice]["type"]
+                category_label = None
                 local_metadata_path = Path.home() / '.local/share/cinnamon' / _type / name / 'metadata.json'
-                if local_metadata_path.exists():
-                    gettext.bindtextdomain(name, str(Path.home() / '.local/share/locale'))
-                    gettext.textdomain(name)
-                    with open(local_metadata_path, encoding="utf-8") as metadata:
-                        json_data = json.load(metadata)
-                        category_label = _(json_data["name"])
-                else:
-                    system_metadata_path = Path("/usr/share/cinnamon") / _type / name / "metadata.json"
-                    if system_metadata_path.exists():
-                        with open(system_metadata_path, encoding="utf-8") as metadata:
-                            json_data = json.load(metadata)
-                            category_label = _(json_data["name"])
+                system_metadata_path = Path("/usr/share/cinnamon") / _type / name / "metadata.json"
+                for metadata_path in (local_metadata_path, system_metadata_path):
+                    if metadata_path.exists():
+                        try:
+                            category_label = _(catalogue.get_name(metadata_path))
+                        except (OSError, ValueError, TypeError):
+                            pass
+                        break
+
                 if not _id:
                     cat_label = category_label if category_label else name
                     CATEGORIES.append([cat_label, name, "spices", None, properties])
@@ -556,37 +748,40 @@ class Module:
                     CATEGORIES.append([label, f"{name}_{instance_num}", name, None, properties])
                     instance_num += 1
 
+                if "@cinnamon.org" not in name and name not in text_domains:
+                    gettext.bindtextdomain(name, str(Path.home() / '.local/share/locale'))
+                    text_domains.add(name)
+
                 properties = spice if spice_properties[spice]["highlight"] is True else None
                 for binding_key, binding_values in bindings.items():
                     if "@cinnamon.org" in name:
                         binding_label = _(list(binding_values.keys())[0])
                     else:
-                        home = os.path.expanduser("~")
-                        gettext.bindtextdomain(name, f"{home}/.local/share/locale")
-                        gettext.textdomain(name)
-                        binding_label = gettext.gettext(list(binding_values.keys())[0])
+                        binding_label = gettext.dgettext(name, list(binding_values.keys())[0])
                     binding_schema = spice_properties[spice]["path"]
                     binding_category = f"{name}_{instance_num - 1}" if _id else name
                     KEYBINDINGS.append([binding_label, binding_schema, binding_key, binding_category, properties])
-                    self.binding_categories[binding_category] = category_label
+                    self.binding_categories[binding_category] = category_label if category_label else name
 
-            cat_lookup = {}
+            catalogue.save()
+
+            self.categories = {}
 
             for cat in CATEGORIES:
-                cat_lookup[cat[1]] = cat[0]
                 elem = None
                 if len(cat) > 4:
                     elem = cat[4]
-                self.main_store.append(KeyBindingCategory(cat[0], cat[1], cat[2], cat[3], elem))
+                category = KeyBindingCategory(cat[0], cat[1], cat[2], cat[3], elem)
+                self.main_store.append(category)
+                self.categories.setdefault(category.int_name, category)
 
             for binding in KEYBINDINGS:
-                self.binding_categories.setdefault(binding[3], cat_lookup[binding[3]])
-                for category in self.main_store:
-                    if category.int_name == binding[3]:
-                        elem = None
-                        if len(binding) > 4:
-                            elem = binding[4]
-                        category.add(KeyBinding(binding[0], binding[1], binding[2], binding[3], elem))
+                category = self.categories[binding[3]]
+                self.binding_categories.setdefault(binding[3], category.label)
+                elem = None
+                if len(binding) > 4:
+                    elem = binding[4]
+                category.add(KeyBinding(binding[0], binding[1], binding[2], binding[3], elem))
 
             cat_iters = {}
             longest_cat_label = " "
@@ -730,6 +925,20 @@ class Module:
                 self.kb_root_store.append((keybinding.label, keybinding))
         self.loadCustoms()
 
+    def getAccelIndex(self):
+        # Building the index loads the entries of every binding, so it's only
+        # done once a search or an assignment actually needs it.
+        if self.accel_index is None:
+            self.accel_index = AcceleratorIndex()
+            for row in self.kb_root_store:
+                self.accel_index.add(row[1])
+
+        return self.accel_index
+
+    def reindexBinding(self, keybinding):
+        if self.accel_index is not None:
+            self.accel_index.update(keybinding)
+
     def kb_name_cell_data_func(self, column, cell, model, tree_iter, data=None):
         binding = model.get_value(tree_iter, 1)
 
@@ -764,8 +973,7 @@ class Module:
 
             search = self.kb_search_binding.get_accel_string()
             if search:
-                entries = [Gtk.accelerator_parse_with_keycode(entry) for entry in keybinding.entries]
-                return Gtk.accelerator_parse_with_keycode(search) in entries
+                return self.getAccelIndex().uses(keybinding, search)
 
             if self.current_category and hasattr(self.current_category, 'int_name'):
                 return keybinding.category == self.current_category.int_name
@@ -779,13 +987,15 @@ class Module:
             # that isn't, otherwise we may skip one.
             keybinding = self.kb_root_store.get_value(tree_iter, 1)
             if keybinding.category == "custom":
+                if self.accel_index is not None:
+                    self.accel_index.remove(keybinding)
                 if not self.kb_root_store.remove(tree_iter):
                     break
                 continue
 
             tree_iter = self.kb_root_store.iter_next(tree_iter)
 
-        parent = Gio.Settings.new(CUSTOM_KEYS_PARENT_SCHEMA)
+        parent = getSchemaSettings(CUSTOM_KEYS_PARENT_SCHEMA)
         custom_list = parent.get_strv("custom-list")
 
         for entry in custom_list:
@@ -799,6 +1009,8 @@ class Module:
                                          schema.get_string("command"),
                                          schema.get_strv("binding"))
             self.kb_root_store.append((custom_kb.label, custom_kb))
+            if self.accel_index is not None:
+                self.accel_index.add(custom_kb)
             self.binding_categories.setdefault("custom", _("Custom Shortcuts"))
 
     def onKeyBindingChanged(self, tree):
@@ -833,32 +1045,31 @@ class Module:
             current_keybinding = keybindings.get_value(kb_iter, 1)
 
         # Check for duplicates
-        for category in self.main_store:
-            for keybinding in category.keybindings:
-                for entry in keybinding.entries:
-                    found = False
-                    if Gtk.accelerator_parse_with_keycode(accel_string) == Gtk.accelerator_parse_with_keycode(entry):
-                        found = True
-
-                    if found and keybinding.label != current_keybinding.label:
-                        dialog = Gtk.MessageDialog(None,
-                                                   Gtk.DialogFlags.DESTROY_WITH_PARENT,
-                                                   Gtk.MessageType.QUESTION,
-                                                   Gtk.ButtonsType.YES_NO,
-                                                   None)
-                        dialog.set_default_size(400, 200)
-                        msg = _("This key combination, <b>%(combination)s</b> is currently in use by <b>%(old)s</b>.  ")
-                        msg += _("If you continue, the combination will be reassigned to <b>%(new)s</b>.\n\n")
-                        msg += _("Do you want to continue with this operation?")
-                        dialog.set_markup(msg % {'combination': escape(accel_label), 'old': escape(keybinding.label), 'new': escape(current_keybinding.label)})
-                        dialog.show_all()
-                        response = dialog.run()
-                        dialog.destroy()
-                        if response == Gtk.ResponseType.YES:
-                            keybinding.setBinding(keybinding.entries.index(entry), None)
-                        else:
-                            return
+        for keybinding in self.getAccelIndex().find(accel_string):
+            if keybinding.label == current_keybinding.label:
+                continue
+
+            dialog = Gtk.MessageDialog(None,
+                                       Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                                       Gtk.MessageType.QUESTION,
+                                       Gtk.ButtonsType.YES_NO,
+                                       None)
+            dialog.set_default_size(400, 200)
+            msg = _("This key combination, <b>%(combination)s</b> is currently in use by <b>%(old)s</b>.  ")
+            msg += _("If you continue, the combination will be reassigned to <b>%(new)s</b>.\n\n")
+            msg += _("Do you want to continue with this operation?")
+            dialog.set_markup(msg % {'combination': escape(accel_label), 'old': escape(keybinding.label), 'new': escape(current_keybinding.label)})
+            dialog.show_all()
+            response = dialog.run()
+            dialog.destroy()
+            if response == Gtk.ResponseType.YES:
+                for index in self.accel_index.find_entries(keybinding, accel_string):
+                    keybinding.setBinding(index, None)
+                self.reindexBinding(keybinding)
+            else:
+                return
         current_keybinding.setBinding(int(path), accel_string)
+        self.reindexBinding(current_keybinding)
         self.onKeyBindingChanged(self.kb_tree)
         self.entry_tree.get_selection().select_path(path)
 
@@ -867,6 +1078,7 @@ class Module:
         if kb_iter:
             current_keybinding = keybindings.get_value(kb_iter, 1)
         current_keybinding.setBinding(int(path), None)
+        self.reindexBinding(current_keybinding)
         self.onKeyBindingChanged(self.kb_tree)
         self.entry_tree.get_selection().select_path(path)
 
@@ -886,6 +1098,27 @@ class Module:
         self.kb_search_binding.load_model()
         self.kb_store.refilter()
 
+    def onShowConflictsButtonClicked(self, button):
+        conflicts = self.getAccelIndex().get_conflicts()
+
+        dialog = Gtk.MessageDialog(None,
+                                   Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                                   Gtk.MessageType.INFO,
+                                   Gtk.ButtonsType.CLOSE,
+                                   None)
+        dialog.set_default_size(400, 200)
+        if conflicts:
+            lines = [_("These key combinations are used by more than one shortcut:"), ""]
+            for label, keybindings in conflicts:
+                names = ", ".join(escape(keybinding.label) for keybinding in keybindings)
+                lines.append("<b>%s</b>: %s" % (escape(label), names))
+            dialog.set_markup("\n".join(lines))
+        else:
+            dialog.set_markup(_("No key combination is used by more than one shortcut."))
+        dialog.show_all()
+        dialog.run()
+        dialog.destroy()
+
     def onAddCustomButtonClicked(self, button):
         dialog = AddCustomDialog(False)
 
@@ -1015,13 +1248,11 @@ class Module:
                         self.cat_tree.set_cursor(Gtk.TreePath(str(index)), None, False)
                         break
             else:
-                for category in self.main_store:
-                    if category.int_name == binding.category:
-                        cat_iter = self.recurseCatTree(self.cat_store.get_iter_first(), binding.category)
-                        _path = self.cat_store.get_path(cat_iter)
-                        self.cat_tree.expand_to_path(_path)
-                        self.cat_tree.set_cursor(_path)
-                        break
+                if binding.category in self.categories:
+                    cat_iter = self.recurseCatTree(self.cat_store.get_iter_first(), binding.category)
+                    _path = self.cat_store.get_path(cat_iter)
+                    self.cat_tree.expand_to_path(_path)
+                    self.cat_tree.set_cursor(_path)
 
         if binding and hasattr(binding, "properties") and binding.properties:
             if not self.current_category:
@@ -1081,6 +1312,7 @@ class Module:
 
     def onResetToDefault(self, popup, keybinding):
         keybinding.resetDefaults()
+        self.reindexBinding(keybinding)
         self.onKeyBindingChanged(self.kb_tree)
 
     def categoryHighlightOnMap(self, *args):
@@ -1159,21 +1391,34 @@ class KeyBinding:
         self.category = category
         self.label = label
         self.schema = schema
-        self.entries = []
-        self.settings = Gio.Settings.new(schema) if "/" not in schema else schema
         self.properties = properties
-        self.loadSettings()
+        # Spice keybindings (schema is the path of the config file) don't use
+        # Gio.Settings at all. The entries are loaded on first use.
+        self._entries = None
+
+    @property
+    def settings(self):
+        return getSchemaSettings(self.schema) if "/" not in self.schema else self.schema
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self.loadSettings()
+        return self._entries
 
     def loadSettings(self):
-        del self.entries[:]
-        self.entries = self.get_array(self.settings.get_strv(self.key)) if "/" not in self.settings else self.getConfigSettings()
+        self._entries = self.get_array(self.settings.get_strv(self.key)) if "/" not in self.schema else self.getConfigSettings()
 
     def getConfigSettings(self):
-        with open(self.schema, encoding="utf-8") as config_file:
-            config = json.load(config_file)
-            keybinds = config[self.key]["value"].split("::")
-            if len(keybinds) < 2:
-                keybinds.append("")
+        value = spice_config_writer.get_pending(self.schema, self.key)
+        if value is None:
+            with open(self.schema, encoding="utf-8") as config_file:
+                config = json.load(config_file)
+                value = config[self.key]["value"]
+
+        keybinds = value.split("::")
+        if len(keybinds) < 2:
+            keybinds.append("")
 
         return keybinds
 
@@ -1200,13 +1445,7 @@ class KeyBinding:
         if "/" not in self.schema:
             self.settings.set_strv(self.key, array)
         else:
-            with open(self.schema, encoding="utf-8") as config_file:
-                config = json.load(config_file)
-
-            config[self.key]["value"] = "::".join(array) if array else "::"
-
-            with open(self.schema, "w", encoding="utf-8") as config_file:
-                config_file.write(json.dumps(config, indent=4))
+            spice_config_writer.queue(self.schema, self.key, "::".join(array) if array else "::")
 
     def resetDefaults(self):
         if "/" not in self.schema:
@@ -1215,10 +1454,7 @@ class KeyBinding:
             with open(self.schema, encoding="utf-8") as config_file:
                 config = json.load(config_file)
 
-            config[self.key]["value"] = config[self.key]["default"]
-
-            with open(self.schema, "w", encoding="utf-8") as config_file:
-                config_file.write(json.dumps(config, indent=4))
+            spice_config_writer.queue(self.schema, self.key, config[self.key]["default"])
 
         self.loadSettings()
 
@@ -1258,7 +1494,7 @@ class CustomKeyBinding:
         settings.set_strv("binding", array)
 
         # Touch the custom-list key, this will trigger a rebuild in cinnamon
-        parent = Gio.Settings.new(CUSTOM_KEYS_PARENT_SCHEMA)
+        parent = getSchemaSettings(CUSTOM_KEYS_PARENT_SCHEMA)
         custom_list = parent.get_strv("custom-list")
         ensureCustomListChanges(custom_list)
         parent.set_strv("custom-list", custom_list)
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
 import collections
+import concurrent.futures
+import json
 import os
 import glob
 import shutil
@@ -23,8 +25,20 @@ AUTOSTART_APPS = collections.OrderedDict()
 
 KEYFILE_FLAGS = GLib.KeyFileFlags.KEEP_COMMENTS and GLib.KeyFileFlags.KEEP_TRANSLATIONS
 
+DESKTOP_ENTRY_WORKERS = 4
+
 DELAY_GROUP = Gtk.SizeGroup.new(Gtk.SizeGroupMode.HORIZONTAL)
 
+STARTUP_PROFILER = "cinnamon-startup-profiler"
+STARTUP_PROFILE_FILE = os.path.join(GLib.get_user_cache_dir(), "cinnamon", "startup-profile.json")
+STARTUP_PROFILE = {}
+startup_profile_mtime = None
+PROFILE_COLUMNS = [("launch", _("Started"), _("Sort by start time")),
+                   ("cpu", _("CPU"), _("Sort by CPU time")),
+                   ("rss", _("Memory"), _("Sort by memory")),
+                   ("io", _("Disk I/O"), _("Sort by disk I/O"))]
+PROFILE_GROUPS = {field: Gtk.SizeGroup.new(Gtk.SizeGroupMode.HORIZONTAL) for (field, title, sort_label) in PROFILE_COLUMNS}
+
 def list_header_func(row, before, user_data):
     if before and not row.get_header():
         row.set_header(Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL))
@@ -38,6 +52,120 @@ def get_appname(filename):
     return basename
 
 
+def get_string(key_file, key, default_value=None):
+    try:
+        retval = key_file.get_string(D_GROUP, key)
+    except:
+        retval = default_value
+
+    return retval
+
+
+def get_locale_string(key_file, key, default_value=None):
+    try:
+        retval = key_file.get_locale_string(D_GROUP, key, None)
+    except:
+        retval = default_value
+
+    return retval
+
+
+def get_boolean(key_file, key, default_value):
+    try:
+        retval = key_file.get_boolean(D_GROUP, key)
+    except:
+        retval = default_value
+
+    return retval
+
+
+def get_shown(key_file):
+    try:
+        only_show_in = key_file.get_string_list(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_ONLY_SHOW_IN)
+    except:
+        only_show_in = False
+
+    if only_show_in:
+        found = False
+        for i in only_show_in:
+            if i in ('GNOME', 'X-Cinnamon'):
+                found = True
+                break
+        if not found:
+            return False
+
+    try:
+        not_show_in = key_file.get_string_list(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_NOT_SHOW_IN)
+    except:
+        not_show_in = False
+
+    if not_show_in:
+        found = False
+        for i in not_show_in:
+            if i == ENVIRON:
+                found = True
+                break
+        if found:
+            return False
+
+    return True
+
+
+def get_field_digest(hidden, enabled, shown, no_display, name, comment, command, delay, icon):
+    """ The fields which decide if a user autostart file can be replaced by the system one """
+    return (hidden, enabled, shown, no_display, name, comment, command, delay, icon)
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_profiler_autostart_file():
+    return os.path.join(GLib.get_user_config_dir(), "autostart", STARTUP_PROFILER + ".desktop")
+
+
+def load_startup_profile():
+    """ Averages what cinnamon-startup-profiler recorded over the last logins.
+        Returns False if the file didn't change since it was last loaded. """
+    global startup_profile_mtime
+    mtime = get_mtime(STARTUP_PROFILE_FILE)
+    if mtime == startup_profile_mtime:
+        return False
+    startup_profile_mtime = mtime
+
+    STARTUP_PROFILE.clear()
+    try:
+        with open(STARTUP_PROFILE_FILE, encoding="utf-8") as profile_file:
+            sessions = json.load(profile_file)["sessions"]
+    except (OSError, ValueError, KeyError):
+        return True
+
+    samples = {}
+    for session in sessions:
+        for appname, numbers in session["apps"].items():
+            samples.setdefault(appname, []).append(numbers)
+
+    for appname, app_samples in samples.items():
+        profile = {"count": len(app_samples)}
+        for field in ("launch", "idle", "cpu", "rss", "io"):
+            values = [numbers[field] for numbers in app_samples if numbers.get(field) is not None]
+            profile[field] = sum(values) / len(values) if values else None
+        STARTUP_PROFILE[appname] = profile
+
+    return True
+
+
+def format_profile_value(field, value):
+    if value is None:
+        return "-"
+    if field in ("rss", "io"):
+        return GLib.format_size(int(value))
+    return _("%.1f s") % value
+
+
 def get_blacklisted_apps():
     source = Gio.SettingsSchemaSource.get_default()
     schema = source.lookup('org.cinnamon.SessionManager', True)
@@ -57,6 +185,10 @@ class Module:
         keywords = _("startup, programs, boot, init, session, autostart, apps")
         sidePage = SidePage(_("Startup Applications"), "cs-startup-programs", keywords, content_box, module=self)
         self.sidePage = sidePage
+        self.autostart_box = None
+        self.monitors = []
+        self.changed_paths = set()
+        self.update_id = 0
 
     def on_module_selected(self):
         if not self.loaded:
@@ -67,17 +199,24 @@ class Module:
             self.sidePage.add_widget(page)
 
             self.ensure_user_autostart_dir()
+            load_startup_profile()
 
             settings = AutostartBox(_("Startup Applications"))
             page.pack_start(settings, True, True, 0)
+            self.autostart_box = settings
 
             self.gather_apps()
 
             for app in AUTOSTART_APPS.values():
-                if app.key_file_loaded and app.shown and not app.no_display and not app.hidden:
+                if app.is_listed():
                     row = AutostartRow(app)
                     settings.add_row(row)
 
+            self.monitor_autostart_dirs()
+        else:
+            # the profiler may have run since the module was last shown
+            self.autostart_box.reload_profile()
+
     def ensure_user_autostart_dir(self):
         user_autostart_dir = os.path.join(GLib.get_user_config_dir(), "autostart")
         if not os.path.isdir(user_autostart_dir):
@@ -86,21 +225,27 @@ class Module:
             except:
                 print("Could not create autostart dir: %s" % user_autostart_dir)
 
+    def get_autostart_dirs(self):
+        return [os.path.join(GLib.get_user_config_dir(), "autostart")] + \
+               [os.path.join(d, "autostart") for d in GLib.get_system_config_dirs()]
+
     def gather_apps(self):
         system_files = []
 
         blacklisted_apps = get_blacklisted_apps()
 
         user_files = glob.glob(os.path.join(GLib.get_user_config_dir(), "autostart", "*.desktop"))
+        for d in GLib.get_system_config_dirs():
+            system_files.extend(glob.glob(os.path.join(d, "autostart", "*.desktop")))
+
+        DESKTOP_ENTRIES.load_all(user_files + system_files)
+
         for app in user_files:
             key = get_appname(app)
             if key in blacklisted_apps:
                 continue
             AUTOSTART_APPS[key] = AutostartApp(app, user_position=os.path.dirname(app))
 
-        for d in GLib.get_system_config_dirs():
-            system_files.extend(glob.glob(os.path.join(d, "autostart", "*.desktop")))
-
         for sys_app in system_files:
             key = get_appname(sys_app)
             if key in blacklisted_apps:
@@ -111,6 +256,155 @@ class Module:
                 AUTOSTART_APPS[key] = AutostartApp(sys_app,
                                                    system_position=os.path.dirname(sys_app))
 
+    def find_app(self, key):
+        """ Same as gather_apps(), for a single app """
+        app = None
+
+        user_app = os.path.join(GLib.get_user_config_dir(), "autostart", key + ".desktop")
+        if os.path.exists(user_app):
+            app = AutostartApp(user_app, user_position=os.path.dirname(user_app))
+
+        for d in GLib.get_system_config_dirs():
+            sys_app = os.path.join(d, "autostart", key + ".desktop")
+            if not os.path.exists(sys_app):
+                continue
+            if app is not None:
+                app.system_position = os.path.dirname(sys_app)
+            else:
+                app = AutostartApp(sys_app, system_position=os.path.dirname(sys_app))
+
+        return app
+
+    def monitor_autostart_dirs(self):
+        for path in self.get_autostart_dirs():
+            if not os.path.isdir(path):
+                continue
+            try:
+                monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+                monitor.connect("changed", self.on_autostart_dir_changed)
+                self.monitors.append(monitor)
+            except GLib.Error as e:
+                print("Could not monitor %s: %s" % (path, e.message))
+
+    def on_autostart_dir_changed(self, monitor, file, other_file, event_type):
+        for changed_file in (file, other_file):
+            if changed_file is not None and changed_file.get_basename().endswith(".desktop"):
+                self.changed_paths.add(changed_file.get_path())
+
+        if self.update_id > 0:
+            GLib.source_remove(self.update_id)
+        self.update_id = GLib.timeout_add(500, self.update_changed_apps)
+
+    def update_changed_apps(self):
+        self.update_id = 0
+
+        # Files this module wrote itself are already up to date in the cache
+        changed_keys = set()
+        for path in self.changed_paths:
+            if not DESKTOP_ENTRIES.is_current(path):
+                changed_keys.add(get_appname(path))
+        self.changed_paths.clear()
+
+        DESKTOP_ENTRIES.load_all([os.path.join(d, key + ".desktop") for d in self.get_autostart_dirs() for key in changed_keys])
+
+        blacklisted_apps = get_blacklisted_apps()
+        for key in changed_keys:
+            if key in blacklisted_apps:
+                continue
+
+            old_app = AUTOSTART_APPS.pop(key, None)
+            app = self.find_app(key)
+            if app is not None:
+                AUTOSTART_APPS[key] = app
+            self.autostart_box.replace_app(old_app, app)
+
+        return False
+
+class DesktopEntry:
+    """ The parsed fields of a desktop file, as it is on disk """
+    def __init__(self, path, mtime, key_file):
+        self.path = path
+        self.mtime = mtime
+        self.key_file = key_file
+
+        self.hidden = get_boolean(key_file, GLib.KEY_FILE_DESKTOP_KEY_HIDDEN, False)
+        self.no_display = get_boolean(key_file, GLib.KEY_FILE_DESKTOP_KEY_NO_DISPLAY, False)
+        self.shown = get_shown(key_file)
+        self.name = get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_NAME, _("Unavailable"))
+        self.comment = get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_COMMENT, _("No description"))
+        self.delay = get_string(key_file, "X-GNOME-Autostart-Delay", "0")
+        self.enabled = get_boolean(key_file, "X-GNOME-Autostart-enabled", True)
+        self.command = get_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_EXEC, "")
+        self.icon = get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_ICON, DEFAULT_ICON)
+
+        # A missing name, comment or command never matches a user file
+        self.digest = get_field_digest(self.hidden, self.enabled, self.shown, self.no_display,
+                                       get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_NAME),
+                                       get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_COMMENT),
+                                       get_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_EXEC),
+                                       self.delay, self.icon)
+
+class DesktopEntryCache:
+    """ Parsed desktop files, reused for as long as their mtime doesn't change """
+    def __init__(self):
+        self.entries = {}
+        self.pool = None
+
+    def is_current(self, path):
+        entry = self.entries.get(path)
+        return get_mtime(path) == (entry.mtime if entry is not None else None)
+
+    def lookup(self, path):
+        mtime = get_mtime(path)
+        entry = self.entries.get(path)
+        if entry is None or entry.mtime != mtime:
+            entry = self.read(path, mtime)
+            self.set_entry(path, entry)
+        return entry
+
+    def read(self, path, mtime):
+        key_file = GLib.KeyFile.new()
+        try:
+            key_file.load_from_file(path, KEYFILE_FLAGS)
+        except GLib.GError as e:
+            print("Failed to load %s" % path, e)
+            return None
+        return DesktopEntry(path, mtime, key_file)
+
+    def set_entry(self, path, entry):
+        if entry is not None:
+            self.entries[path] = entry
+        else:
+            self.entries.pop(path, None)
+
+    def load_all(self, paths):
+        """ Reads the files which aren't cached yet, in parallel """
+        stale = []
+        for path in paths:
+            mtime = get_mtime(path)
+            entry = self.entries.get(path)
+            if mtime is None:
+                self.forget(path)
+            elif entry is None or entry.mtime != mtime:
+                stale.append((path, mtime))
+        if len(stale) == 0:
+            return
+
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=DESKTOP_ENTRY_WORKERS)
+        entries = self.pool.map(lambda item: self.read(*item), stale)
+        for (path, mtime), entry in zip(stale, entries):
+            self.set_entry(path, entry)
+
+    def store(self, path, key_file):
+        """ Records a file that was just written, so it's not read again """
+        self.set_entry(path, DesktopEntry(path, get_mtime(path), key_file))
+
+    def forget(self, path):
+        self.entries.pop(path, None)
+
+DESKTOP_ENTRIES = DesktopEntryCache()
+
 class AutostartApp:
     def __init__(self, app, user_position=None, system_position=None):
         self.app = app
@@ -126,81 +420,28 @@ class AutostartApp:
         self.load()
 
     def load(self):
-        try:
-            self.key_file.load_from_file(self.app, KEYFILE_FLAGS)
-        except GLib.GError as e:
-            print("Failed to load %s" % self.app, e)
+        entry = DESKTOP_ENTRIES.lookup(self.app)
+        if entry is None:
             return
 
+        self.key_file = entry.key_file
         self.key_file_loaded = True
 
         self.basename = os.path.basename(self.app)
         self.dir = os.path.dirname(self.app)
 
-        self.hidden = self.get_boolean(self.key_file, GLib.KEY_FILE_DESKTOP_KEY_HIDDEN, False)
-        self.no_display = self.get_boolean(self.key_file, GLib.KEY_FILE_DESKTOP_KEY_NO_DISPLAY, False)
-        self.shown = self.get_shown(self.key_file)
-        self.name = self.get_locale_string(self.key_file, GLib.KEY_FILE_DESKTOP_KEY_NAME, _("Unavailable"))
-        self.comment = self.get_locale_string(self.key_file, GLib.KEY_FILE_DESKTOP_KEY_COMMENT, _("No description"))
-        self.delay = self.get_string(self.key_file, "X-GNOME-Autostart-Delay", "0")
-        self.enabled = self.get_boolean(self.key_file, "X-GNOME-Autostart-enabled", True)
-        self.command = self.get_string(self.key_file, GLib.KEY_FILE_DESKTOP_KEY_EXEC, "")
-        self.icon = self.get_locale_string(self.key_file, GLib.KEY_FILE_DESKTOP_KEY_ICON, DEFAULT_ICON)
-
-    def get_string(self, key_file, key, default_value=None):
-        try:
-            retval = key_file.get_string(D_GROUP, key)
-        except:
-            retval = default_value
-
-        return retval
-
-    def get_locale_string(self, key_file, key, default_value=None):
-        try:
-            retval = key_file.get_locale_string(D_GROUP, key, None)
-        except:
-            retval = default_value
-
-        return retval
-
-    def get_boolean(self, key_file, key, default_value):
-        try:
-            retval = key_file.get_boolean(D_GROUP, key)
-        except:
-            retval = default_value
-
-        return retval
-
-    def get_shown(self, key_file):
-        try:
-            only_show_in = key_file.get_string_list(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_ONLY_SHOW_IN)
-        except:
-            only_show_in = False
-
-        if only_show_in:
-            found = False
-            for i in only_show_in:
-                if i in ('GNOME', 'X-Cinnamon'):
-                    found = True
-                    break
-            if not found:
-                return False
+        self.hidden = entry.hidden
+        self.no_display = entry.no_display
+        self.shown = entry.shown
+        self.name = entry.name
+        self.comment = entry.comment
+        self.delay = entry.delay
+        self.enabled = entry.enabled
+        self.command = entry.command
+        self.icon = entry.icon
 
-        try:
-            not_show_in = key_file.get_string_list(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_NOT_SHOW_IN)
-        except:
-            not_show_in = False
-
-        if not_show_in:
-            found = False
-            for i in not_show_in:
-                if i == ENVIRON:
-                    found = True
-                    break
-            if found:
-                return False
-
-        return True
+    def is_listed(self):
+        return self.key_file_loaded and self.shown and not self.no_display and not self.hidden
 
     def save_done_success(self):
         self.save_mask.clear_items()
@@ -210,10 +451,9 @@ class AutostartApp:
             old_app = self.app
             self.app = os.path.join(self.system_position, self.basename)
             os.remove(old_app)
-            self.key_file = GLib.KeyFile.new()
+            DESKTOP_ENTRIES.forget(old_app)
             self.user_position = None
-            if self.key_file.load_from_file(self.app, KEYFILE_FLAGS):
-                self.load()
+            self.load()
             self.save_done_success()
             return False
 
@@ -261,6 +501,7 @@ class AutostartApp:
             key_file.set_string(D_GROUP, "X-GNOME-Autostart-Delay", self.delay)
 
         key_file.save_to_file(self.path)
+        DESKTOP_ENTRIES.store(self.path, key_file)
         self.app = self.path
         self.key_file = key_file
         self.save_done_success()
@@ -303,6 +544,7 @@ class AutostartApp:
     def remove(self):
         if not self.system_position and self.user_position:
             os.remove(self.app)
+            DESKTOP_ENTRIES.forget(self.app)
         else:
             self.hidden = True
             self.save_mask.add_item("hidden")
@@ -320,35 +562,12 @@ class AutostartApp:
         if not self.system_position:
             return False
 
-        path = os.path.join(self.system_position, self.basename)
-        key_file = GLib.KeyFile.new()
-        if not key_file.load_from_file(path, GLib.KeyFileFlags.NONE):
-            return False
-
-        if (self.get_boolean(key_file, GLib.KEY_FILE_DESKTOP_KEY_HIDDEN, False) != self.hidden or
-            self.get_boolean(key_file, "X-GNOME-Autostart-enabled", True) != self.enabled or
-                self.get_shown(key_file) != self.shown):
-            return False
-
-        if self.get_boolean(key_file, GLib.KEY_FILE_DESKTOP_KEY_NO_DISPLAY, False) != self.no_display:
-            return False
-
-        if self.get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_NAME) != self.name:
-            return False
-
-        if self.get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_COMMENT) != self.comment:
-            return False
-
-        if self.get_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_EXEC) != self.command:
+        entry = DESKTOP_ENTRIES.lookup(os.path.join(self.system_position, self.basename))
+        if entry is None:
             return False
 
-        if self.get_string(key_file, "X-GNOME-Autostart-Delay", "0") != self.delay:
-            return False
-
-        if self.get_locale_string(key_file, GLib.KEY_FILE_DESKTOP_KEY_ICON, DEFAULT_ICON) != self.icon:
-            return False
-
-        return True
+        return entry.digest == get_field_digest(self.hidden, self.enabled, self.shown, self.no_display,
+                                                self.name, self.comment, self.command, self.delay, self.icon)
 
     def get_locale(self):
         current_locale = None
@@ -448,10 +667,82 @@ class AutostartBox(Gtk.Box):
         self.run_button.set_sensitive(False)
         box.add(self.run_button)
 
+        self.profile_button = Gtk.ToggleButton()
+        self.profile_button.set_image(Gtk.Image.new_from_icon_name("utilities-system-monitor-symbolic", Gtk.IconSize.BUTTON))
+        self.profile_button.set_tooltip_text(_("Measure the startup applications at each login"))
+        self.profile_button.set_active(os.path.exists(get_profiler_autostart_file()))
+        self.profile_button.connect("toggled", self.on_profile_button_toggled)
+        button_group.add_widget(self.profile_button)
+        box.add(self.profile_button)
+
+        # Sorting by the measured numbers, once there are some
+        self.sort_key = "name"
+        self.sort_holder = Gtk.ToolItem()
+        button_toolbar.add(self.sort_holder)
+        self.sort_combo = Gtk.ComboBoxText()
+        self.sort_combo.append("name", _("Sort by name"))
+        for (field, title, sort_label) in PROFILE_COLUMNS:
+            self.sort_combo.append(field, sort_label)
+        self.sort_combo.set_active_id(self.sort_key)
+        self.sort_combo.connect("changed", self.on_sort_combo_changed)
+        self.sort_holder.add(self.sort_combo)
+        self.sort_holder.set_no_show_all(True)
+        if STARTUP_PROFILE:
+            self.sort_combo.show()
+            self.sort_holder.show()
+
     def add_row(self, row):
         self.list_box.add(row)
 
+    def replace_app(self, old_app, app):
+        selected = False
+        if old_app is not None:
+            for row in self.list_box.get_children():
+                if row.app is old_app:
+                    selected = row.is_selected()
+                    self.list_box.remove(row)
+                    break
+
+        if app is not None and app.is_listed():
+            row = AutostartRow(app)
+            self.add_row(row)
+            row.show_all()
+            if selected:
+                self.list_box.select_row(row)
+        elif selected:
+            self.edit_button.set_sensitive(False)
+            self.remove_button.set_sensitive(False)
+            self.run_button.set_sensitive(False)
+
+    def reload_profile(self):
+        """ shows what the profiler recorded since the rows were made """
+        if not load_startup_profile():
+            return
+
+        for row in self.list_box.get_children():
+            self.replace_app(row.app, row.app)
+
+        if STARTUP_PROFILE:
+            self.sort_combo.show()
+            self.sort_holder.show()
+        else:
+            self.sort_combo.set_active_id("name")
+            self.sort_holder.hide()
+
     def sort_apps(self, a, b, user_data):
+        if self.sort_key != "name":
+            # in start order, otherwise costliest first. Apps which weren't measured go last.
+            avalue = a.get_profile_value(self.sort_key)
+            bvalue = b.get_profile_value(self.sort_key)
+            if avalue != bvalue:
+                if avalue is None:
+                    return 1
+                if bvalue is None:
+                    return -1
+                if self.sort_key == "launch":
+                    return -1 if avalue < bvalue else 1
+                return -1 if avalue > bvalue else 1
+
         aname = a.app.name.lower()
         bname = b.app.name.lower()
 
@@ -462,6 +753,31 @@ class AutostartBox(Gtk.Box):
         else:
             return 0
 
+    def on_sort_combo_changed(self, combo):
+        self.sort_key = combo.get_active_id()
+        self.list_box.invalidate_sort()
+
+    def on_profile_button_toggled(self, button):
+        path = get_profiler_autostart_file()
+        if button.get_active():
+            key_file = GLib.KeyFile.new()
+            key_file.set_string(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_TYPE, "Application")
+            key_file.set_string(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_NAME, _("Startup profiler"))
+            key_file.set_string(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_EXEC, STARTUP_PROFILER)
+            key_file.set_boolean(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_NO_DISPLAY, True)
+            key_file.set_string_list(D_GROUP, GLib.KEY_FILE_DESKTOP_KEY_ONLY_SHOW_IN, ["X-Cinnamon"])
+            try:
+                key_file.save_to_file(path)
+            except GLib.Error as e:
+                print("Could not enable the startup profiler: %s" % e.message)
+        else:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print("Could not disable the startup profiler: %s" % e)
+
+        self.reload_profile()
+
     def on_row_selected(self, list_box, row):
         self.edit_button.set_sensitive(True)
         self.remove_button.set_sensitive(True)
@@ -706,6 +1022,26 @@ class AutostartRow(Gtk.ListBoxRow):
         grid.attach_next_to(self.desc_box, img, Gtk.PositionType.RIGHT, 1, 1)
         self.desc_box.set_sensitive(app.enabled)
 
+        # What the app cost at the last logins, when the profiler was enabled
+        last_column = self.desc_box
+        if STARTUP_PROFILE:
+            profile = STARTUP_PROFILE.get(get_appname(self.app.app), {})
+            for (field, title, sort_label) in PROFILE_COLUMNS:
+                column = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+                PROFILE_GROUPS[field].add_widget(column)
+                column.set_margin_right(15)
+                column.pack_start(Gtk.Label(title), False, False, 0)
+                value_label = Gtk.Label(format_profile_value(field, profile.get(field)))
+                value_label.get_style_context().add_class("dim-label")
+                column.pack_start(value_label, False, False, 0)
+                grid.attach_next_to(column, last_column, Gtk.PositionType.RIGHT, 1, 1)
+                last_column = column
+
+                if field == "launch" and profile:
+                    column.set_tooltip_text(_("Average of the last %d logins") % profile["count"])
+                elif field == "cpu" and profile.get("idle") is not None:
+                    column.set_tooltip_text(_("Busy for %.1f s after starting") % profile["idle"])
+
         self.delay_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         DELAY_GROUP.add_widget(self.delay_box)
         self.delay_box.props.hexpand = False
@@ -720,7 +1056,7 @@ class AutostartRow(Gtk.ListBoxRow):
         self.delay_time_label.set_markup(_("%s s") % delay_time_markup)
         self.delay_time_label.get_style_context().add_class("dim-label")
         self.delay_box.pack_start(self.delay_time_label, False, False, 0)
-        grid.attach_next_to(self.delay_box, self.desc_box, Gtk.PositionType.RIGHT, 1, 1)
+        grid.attach_next_to(self.delay_box, last_column, Gtk.PositionType.RIGHT, 1, 1)
         self.delay_box.set_sensitive(app.enabled)
 
         self.delay_label.set_visible(delay_time_markup != "0")
@@ -737,6 +1073,10 @@ class AutostartRow(Gtk.ListBoxRow):
 
         self.add(widget)
 
+    def get_profile_value(self, field):
+        profile = STARTUP_PROFILE.get(get_appname(self.app.app))
+        return profile.get(field) if profile is not None else None
+
     def update(self):
         name_markup = GLib.markup_escape_text(self.app.name)
         comment_markup = GLib.markup_escape_text(self.app.comment)
@@ -2,16 +2,21 @@
 
 import os
 import json
+import stat
+import hashlib
+import threading
+import concurrent.futures
 import tinycss2
 
 from gi.repository import Gtk, GdkPixbuf
 
 from xapp.GSettingsWidgets import *
 from CinnamonGtkSettings import CssRange, CssOverrideSwitch, GtkSettingsSwitch, PreviewWidget, Gtk2ScrollbarSizeEditor
-from SettingsWidgets import LabelRow, SidePage, walk_directories
+from SettingsWidgets import LabelRow, SidePage
 from ChooserButtonWidgets import PictureChooserButton
 from ExtensionCore import DownloadSpicesPage
 from Spices import Spice_Harvester
+from bin import fileutil
 
 from pathlib import Path
 import config
@@ -42,6 +47,516 @@ THEMES_BLACKLIST = [
     "humanity", "humanity-dark"  # same
 ]
 
+THEME_INDEX_FILE = os.path.join(GLib.get_user_cache_dir(), "cs_themes", "theme-index.json")
+THEME_INDEX_VERSION = 2
+
+class ThemeIndex:
+    """ records what each installed theme provides, so that theme folders are only
+        scanned again when they changed. Updates are done in a thread. """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        # folder -> {"themes": {name: {"key": [mtimes], capabilities}}}
+        self.folders = {}
+        self.cached = False
+        self.invalid = set()
+        self.updating = False
+        self.update_again = False
+
+    def load(self):
+        try:
+            with open(self.cache_file, encoding="utf-8") as cache:
+                data = json.load(cache)
+            if data.get("version") == THEME_INDEX_VERSION:
+                self.folders = data["folders"]
+                self.cached = True
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def get_themes(self, folders, capability):
+        # same order and format as walk_directories()
+        valid = []
+        for folder in folders:
+            if folder not in self.folders:
+                continue
+            for name, theme in self.folders[folder]["themes"].items():
+                if theme.get(capability):
+                    valid.append([name, folder])
+        return valid
+
+    def get_thumbnail(self, folder, name, path_suffix):
+        try:
+            return self.folders[folder]["themes"][name].get("thumbnail-" + path_suffix)
+        except KeyError:
+            return None
+
+    def invalidate(self, path):
+        self.invalid.add(path)
+
+    def update(self, callback):
+        """ rescans what changed, then calls callback(changed) from the main loop """
+        if self.updating:
+            self.update_again = True
+            return
+
+        self.updating = True
+        invalid = self.invalid
+        self.invalid = set()
+        thread = threading.Thread(target=self.update_thread, args=(self.folders, invalid, callback), daemon=True)
+        thread.start()
+
+    def update_thread(self, folders, invalid, callback):
+        new_folders = {}
+        for folder, scan_func, key_func in [(folder, self.scan_theme, self.get_theme_key) for folder in THEME_FOLDERS] + \
+                                           [(folder, self.scan_icon_theme, self.get_icon_theme_key) for folder in ICON_FOLDERS]:
+            result = self.scan_folder(folder, folders.get(folder), invalid, scan_func, key_func)
+            if result is not None:
+                new_folders[folder] = result
+
+        changed = new_folders != folders
+        if changed:
+            self.save(new_folders)
+
+        GLib.idle_add(self.on_update_done, new_folders, changed, callback)
+
+    def on_update_done(self, folders, changed, callback):
+        self.folders = folders
+        self.updating = False
+        callback(changed)
+
+        if self.update_again:
+            self.update_again = False
+            self.update(callback)
+
+        return False
+
+    def scan_folder(self, folder, cached, invalid, scan_func, key_func):
+        cached_themes = cached["themes"] if cached is not None else {}
+        themes = {}
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return None
+
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(info.st_mode):
+                continue
+
+            # a theme is only scanned again when something it was probed for
+            # could have changed
+            key = key_func(path, info)
+            theme = cached_themes.get(name)
+            if theme is None or theme["key"] != key or path in invalid:
+                theme = scan_func(path)
+                theme["key"] = key
+            themes[name] = theme
+
+        return {"themes": themes}
+
+    def get_mtimes(self, paths):
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def get_theme_key(self, path, info):
+        # adding or removing gtk-3.*/gtk.css or a thumbnail changes the mtime
+        # of the folder it's in
+        subdirs = sorted(str(gtk3_dir) for gtk3_dir in Path(path).glob("gtk-3.*"))
+        subdirs += [os.path.join(path, "cinnamon")]
+        return [info.st_mtime_ns] + self.get_mtimes(subdirs)
+
+    def get_icon_theme_key(self, path, info):
+        return [info.st_mtime_ns] + self.get_mtimes([os.path.join(path, "index.theme")])
+
+    def scan_theme(self, path):
+        theme = {}
+        for gtk3_dir in Path(path).glob("gtk-3.*"):
+            # Skip gtk key themes
+            if os.path.exists(os.path.join(gtk3_dir, "gtk.css")):
+                theme["gtk-3.0"] = True
+                break
+        if os.path.exists(os.path.join(path, "cinnamon")):
+            theme["cinnamon"] = True
+        for path_suffix in ("gtk-3.0", "cinnamon"):
+            thumbnail = os.path.join(path, path_suffix, "thumbnail.png")
+            if os.path.exists(thumbnail):
+                theme["thumbnail-" + path_suffix] = thumbnail
+        return theme
+
+    def scan_icon_theme(self, path):
+        theme = {}
+        index_path = os.path.join(path, "index.theme")
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as index_file:
+                    for line in index_file:
+                        if line.startswith("Directories="):
+                            theme["icons"] = True
+                            break
+            except Exception as e:
+                print (e)
+        if os.path.exists(os.path.join(path, "cursors")):
+            theme["cursors"] = True
+        return theme
+
+    def save(self, folders):
+        try:
+            fileutil.save_cache_file(self.cache_file, {"version": THEME_INDEX_VERSION, "folders": folders})
+        except OSError as e:
+            print(f"Could not save the theme index: {e}")
+
+ICON_PREVIEW_CACHE_FILE = os.path.join(GLib.get_user_cache_dir(), "cs_themes", "icon-previews.json")
+ICON_PREVIEW_WORKERS = 4
+ICON_PREVIEW_BATCH = 4 # Gtk lookups per main loop iteration
+
+def find_icon_theme_dir(name):
+    for folder in ICON_FOLDERS:
+        path = os.path.join(folder, name)
+        if os.path.exists(os.path.join(path, "index.theme")):
+            return path
+    return None
+
+def has_icon_file(theme, icon_name):
+    """ whether the theme, or one it inherits from, has a file for icon_name in one
+        of its folders. It only reads index.theme files and looks for files, so unlike
+        Gtk.IconTheme it can be used from a thread. """
+    queue = [theme]
+    visited = set()
+    while queue:
+        name = queue.pop(0)
+        if name in visited:
+            continue
+        visited.add(name)
+
+        theme_dir = find_icon_theme_dir(name)
+        if theme_dir is not None:
+            keyfile = GLib.KeyFile()
+            try:
+                keyfile.load_from_file(os.path.join(theme_dir, "index.theme"), GLib.KeyFileFlags.NONE)
+                subdirs = keyfile.get_string_list("Icon Theme", "Directories")
+            except GLib.Error:
+                subdirs = []
+
+            # Gtk looks into the folders of that name in every base folder
+            for folder in ICON_FOLDERS:
+                for subdir in subdirs:
+                    for extension in (".svg", ".png"):
+                        if os.path.exists(os.path.join(folder, name, subdir, icon_name + extension)):
+                            return True
+
+            try:
+                queue.extend(keyfile.get_string_list("Icon Theme", "Inherits"))
+            except GLib.Error:
+                pass
+
+        # Gtk always falls back to hicolor last
+        if not queue and "hicolor" not in visited:
+            queue.append("hicolor")
+
+    return False
+
+class IconPreviews:
+    """ finds the folder icon used to preview each icon theme. Worker threads rule
+        out the themes without one, then Gtk looks the others up from the main loop, a
+        few at a time. Results are cached by the theme directory's mtime. A theme
+        without a folder icon is listed with the chooser's placeholder. """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.cache = None
+        self.known = {}
+        self.pool = None
+        self.lookups = []
+        self.lookup_id = 0
+        self.save_id = 0
+
+    def load(self):
+        if self.cache is not None:
+            return
+
+        self.cache = {}
+        try:
+            with open(self.cache_file, encoding="utf-8") as cache:
+                self.cache = json.load(cache)
+        except (OSError, ValueError):
+            pass
+
+        # Known locations shipped with cinnamon-settings, and those saved by older versions
+        for read_path in ('/usr/share/cinnamon/cinnamon-settings/icons',
+                          os.path.join(GLib.get_user_cache_dir(), 'cs_themes', 'icons')):
+            try:
+                with open(read_path, 'r') as known_file:
+                    for line in known_file:
+                        theme_name, sep, icon_path = line.strip().partition(':')
+                        if sep:
+                            self.known[theme_name] = icon_path
+            except OSError:
+                pass
+
+    def find_file(self, relpath):
+        # user folders override system ones
+        for theme_folder in ICON_FOLDERS:
+            path = os.path.join(theme_folder, relpath)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def get_mtime(self, theme):
+        theme_dir = find_icon_theme_dir(theme)
+        if theme_dir is None:
+            return None
+        try:
+            return os.stat(theme_dir).st_mtime_ns
+        except OSError:
+            return None
+
+    def lookup(self, theme):
+        """ returns (found, path). When found is False, the theme needs to be resolved. """
+        entry = self.cache.get(theme)
+        if entry is not None and entry["mtime"] == self.get_mtime(theme):
+            if entry["path"] is None:
+                return True, None
+            path = self.find_file(entry["path"])
+            if path is not None:
+                return True, path
+
+        if theme in self.known:
+            path = self.find_file(self.known[theme])
+            if path is not None:
+                return True, path
+
+        return False, None
+
+    def resolve(self, theme, callback, data):
+        """ looks the preview up in the background, then calls callback(theme, path, data) from the main loop """
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=ICON_PREVIEW_WORKERS)
+        future = self.pool.submit(self.resolve_thread, theme)
+        future.add_done_callback(lambda future: GLib.idle_add(self.on_resolved, theme, future, callback, data))
+
+    def resolve_thread(self, theme):
+        return self.get_mtime(theme), has_icon_file(theme, "folder")
+
+    def on_resolved(self, theme, future, callback, data):
+        try:
+            mtime, found = future.result()
+        except Exception as e:
+            print(f"Could not find a preview for the {theme} icon theme: {e}")
+            mtime, found = None, False
+
+        if not found:
+            self.store(theme, mtime, None, callback, data)
+            return False
+
+        # Gtk isn't thread safe, so the actual lookups are done here
+        self.lookups.append((theme, mtime, callback, data))
+        if self.lookup_id == 0:
+            self.lookup_id = GLib.idle_add(self.do_lookups)
+        return False
+
+    def do_lookups(self):
+        batch = self.lookups[:ICON_PREVIEW_BATCH]
+        self.lookups = self.lookups[ICON_PREVIEW_BATCH:]
+
+        for (theme, mtime, callback, data) in batch:
+            icon_theme = Gtk.IconTheme()
+            icon_theme.set_custom_theme(theme)
+            folder = icon_theme.lookup_icon("folder", ICON_SIZE, Gtk.IconLookupFlags.FORCE_SVG)
+            path = folder.get_filename() if folder is not None else None
+            self.store(theme, mtime, path, callback, data)
+
+        if self.lookups:
+            return True
+
+        self.lookup_id = 0
+        return False
+
+    def store(self, theme, mtime, path, callback, data):
+        # we need to get the relative path for storage
+        relpath = path
+        if path is not None:
+            for theme_folder in ICON_FOLDERS:
+                if os.path.commonpath([theme_folder, path]) == theme_folder:
+                    relpath = os.path.relpath(path, start=theme_folder)
+                    break
+
+        self.cache[theme] = {"mtime": mtime, "path": relpath}
+        if self.save_id > 0:
+            GLib.source_remove(self.save_id)
+        self.save_id = GLib.timeout_add_seconds(2, self.save)
+
+        callback(theme, path, data)
+
+    def save(self):
+        self.save_id = 0
+        try:
+            fileutil.save_cache_file(self.cache_file, self.cache)
+        except OSError as e:
+            print(f"Could not save the icon previews: {e}")
+        return False
+
+THEME_PREVIEW_CACHE_DIR = os.path.join(GLib.get_user_cache_dir(), "cs_themes", "previews")
+THEME_PREVIEW_JOBS = 2
+THEME_PREVIEW_TIMEOUT = 10
+
+# Where Gtk looks for a theme it's given by name, in its order, which isn't quite
+# the one of THEME_FOLDERS
+GTK_THEME_SEARCH_PATH = [
+    os.path.join(GLib.get_user_data_dir(), "themes"),
+    os.path.join(GLib.get_home_dir(), ".themes")
+] + [os.path.join(datadir, "themes") for datadir in GLib.get_system_data_dirs()]
+
+def find_gtk_theme_dir(name):
+    """ the folder Gtk loads a gtk theme from when it's set by name """
+    for folder in GTK_THEME_SEARCH_PATH:
+        path = os.path.join(folder, name)
+        for gtk3_dir in Path(path).glob("gtk-3.*"):
+            if os.path.exists(os.path.join(gtk3_dir, "gtk.css")):
+                return path
+    return None
+
+class ThemePreviews:
+    """ renders thumbnails of gtk themes which don't ship one, with cinnamon-preview-gtk-theme.
+        Renders run in separate processes, a few at a time, and are cached by a hash of the
+        gtk-3 files of the folder the renderer loads the theme from. """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hash_pool = None
+        self.pending = []
+        self.running = 0
+        self.waiting = {} # preview path -> [(name, callback, data)]
+        self.failed = set()
+        self.live = set() # previews hashed since the last prune, only used from the hash thread
+
+    def get_hash_pool(self):
+        # a single worker, so that prune() sees every request made before it
+        if self.hash_pool is None:
+            self.hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self.hash_pool
+
+    def request(self, name, callback, data):
+        """ calls callback(name, path, data) from the main loop once a preview is available """
+        future = self.get_hash_pool().submit(self.hash_theme, name)
+        future.add_done_callback(lambda future: GLib.idle_add(self.on_hashed, name, future, callback, data))
+
+    def prune(self):
+        """ deletes the previews which weren't requested since the last prune """
+        self.get_hash_pool().submit(self.prune_thread)
+
+    def prune_thread(self):
+        live = self.live
+        self.live = set()
+        try:
+            filenames = os.listdir(self.cache_dir)
+        except OSError:
+            return
+
+        for filename in filenames:
+            path = os.path.join(self.cache_dir, filename)
+            # leave files still being written alone
+            if filename.startswith(".") or path in live:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Could not remove an old theme preview: {e}")
+
+    def hash_theme(self, name):
+        # The renderer sets the theme by name, so that's the folder to look at
+        theme_dir = find_gtk_theme_dir(name)
+        if theme_dir is None:
+            raise FileNotFoundError(f"no gtk-3 theme named {name}")
+
+        # Stylesheets decide what the theme looks like, other files only matter by name and size
+        digest = hashlib.sha1()
+        for gtk3_dir in sorted(Path(theme_dir).glob("gtk-3.*")):
+            for root, dirs, files in os.walk(gtk3_dir):
+                dirs.sort()
+                for filename in sorted(files):
+                    path = os.path.join(root, filename)
+                    digest.update(os.path.relpath(path, theme_dir).encode("utf-8", "surrogateescape"))
+                    try:
+                        if filename.endswith(".css"):
+                            with open(path, "rb") as css_file:
+                                digest.update(css_file.read())
+                        else:
+                            digest.update(str(os.path.getsize(path)).encode())
+                    except OSError:
+                        pass
+
+        path = os.path.join(self.cache_dir, f"{digest.hexdigest()}.png")
+        self.live.add(path)
+        return path
+
+    def on_hashed(self, name, future, callback, data):
+        try:
+            path = future.result()
+        except Exception as e:
+            print(f"Could not read the {name} theme: {e}")
+            return False
+
+        if os.path.exists(path):
+            callback(name, path, data)
+        elif path in self.waiting:
+            self.waiting[path].append((name, callback, data))
+        elif path not in self.failed:
+            self.waiting[path] = [(name, callback, data)]
+            self.pending.append((name, path))
+            self.start_renders()
+        return False
+
+    def start_renders(self):
+        while self.pending and self.running < THEME_PREVIEW_JOBS:
+            (name, path) = self.pending.pop(0)
+            try:
+                os.makedirs(self.cache_dir, mode=0o755, exist_ok=True)
+                subproc = Gio.Subprocess.new(["cinnamon-preview-gtk-theme", "--render", path, name],
+                                             Gio.SubprocessFlags.STDOUT_SILENCE | Gio.SubprocessFlags.STDERR_SILENCE)
+            except (OSError, GLib.Error) as e:
+                print(f"Could not render a preview of the {name} theme: {e}")
+                self.on_render_done(path, False)
+                continue
+
+            self.running += 1
+            # Themes which hang or crash Gtk don't get to hold up the others
+            job = {"name": name, "path": path}
+            job["timeout_id"] = GLib.timeout_add_seconds(THEME_PREVIEW_TIMEOUT, self.on_render_timeout, subproc, job)
+            subproc.wait_check_async(None, self.on_rendered, job)
+
+    def on_render_timeout(self, subproc, job):
+        job["timeout_id"] = 0
+        subproc.force_exit()
+        return False
+
+    def on_rendered(self, subproc, result, job):
+        if job["timeout_id"] > 0:
+            GLib.source_remove(job["timeout_id"])
+        self.running -= 1
+
+        try:
+            success = subproc.wait_check_finish(result) and os.path.exists(job["path"])
+        except GLib.Error as e:
+            print(f"Could not render a preview of the {job['name']} theme: {e.message}")
+            success = False
+
+        self.on_render_done(job["path"], success)
+        self.start_renders()
+
+    def on_render_done(self, path, success):
+        waiting = self.waiting.pop(path, [])
+        if not success:
+            self.failed.add(path)
+            return
+        for (name, callback, data) in waiting:
+            callback(name, path, data)
+
 class Style:
     def __init__(self, json_obj):
         self.name = json_obj["name"]
@@ -101,6 +616,11 @@ class Module:
         sidePage = SidePage(_("Themes"), self.icon, self.keywords, content_box, module=self)
         self.sidePage = sidePage
         self.refreshing = False # flag to ensure we only refresh once at any given moment
+        self.theme_index = ThemeIndex(THEME_INDEX_FILE)
+        self.icon_previews = IconPreviews(ICON_PREVIEW_CACHE_FILE)
+        self.theme_previews = ThemePreviews(THEME_PREVIEW_CACHE_DIR)
+        self.chooser_generation = 0 # pictures found for choosers that were refreshed since are dropped
+        self.choose_startup_mode = False
 
     def refresh_themes(self):
         # Find all installed themes
@@ -113,7 +633,7 @@ class Module:
         self.cursor_theme_names = set()
 
         # Gtk themes -- Only shows themes that have a gtk-3.* variation
-        for (name, path) in walk_directories(THEME_FOLDERS, self.filter_func_gtk_dir, return_directories=True):
+        for (name, path) in self.theme_index.get_themes(THEME_FOLDERS, "gtk-3.0"):
             if name.lower() in THEMES_BLACKLIST:
                 continue
             for theme in self.gtk_themes:
@@ -127,7 +647,7 @@ class Module:
         self.gtk_themes.sort(key=lambda a: a[0].lower())
 
         # Cinnamon themes
-        for (name, path) in walk_directories(THEME_FOLDERS, lambda d: os.path.exists(os.path.join(d, "cinnamon")), return_directories=True):
+        for (name, path) in self.theme_index.get_themes(THEME_FOLDERS, "cinnamon"):
             for theme in self.cinnamon_themes:
                 if name == theme[0]:
                     if path == THEME_FOLDERS[0]:
@@ -139,27 +659,18 @@ class Module:
         self.cinnamon_themes.sort(key=lambda a: a[0].lower())
 
         # Icon themes
-        walked = walk_directories(ICON_FOLDERS, lambda d: os.path.isdir(d), return_directories=True)
         valid = []
-        for directory in walked:
+        for directory in self.theme_index.get_themes(ICON_FOLDERS, "icons"):
             if directory[0].lower() in THEMES_BLACKLIST:
                 continue
-            path = os.path.join(directory[1], directory[0], "index.theme")
-            if os.path.exists(path):
-                try:
-                    for line in list(open(path)):
-                        if line.startswith("Directories="):
-                            valid.append(directory)
-                            break
-                except Exception as e:
-                    print (e)
+            valid.append(directory)
         valid.sort(key=lambda a: a[0].lower())
         for (name, path) in valid:
             if name not in self.icon_theme_names:
                 self.icon_theme_names.append(name)
 
         # Cursor themes
-        for (name, path) in walk_directories(ICON_FOLDERS, lambda d: os.path.isdir(d) and os.path.exists(os.path.join(d, "cursors")), return_directories=True):
+        for (name, path) in self.theme_index.get_themes(ICON_FOLDERS, "cursors"):
             if name.lower() in THEMES_BLACKLIST:
                 continue
             for theme in self.cursor_themes:
@@ -176,6 +687,9 @@ class Module:
         if not self.loaded:
             print("Loading Themes module")
 
+            # Start from what was found last time, the index is brought up
+            # to date in the background further down.
+            self.theme_index.load()
             self.refresh_themes()
 
             self.ui_ready = True
@@ -345,7 +859,13 @@ class Module:
 
             self.refresh_choosers()
             if config.PARSED_ARGS.module is None or (config.PARSED_ARGS.module == "themes" and config.PARSED_ARGS.tab is None):
-                GLib.idle_add(self.set_mode, "simplified" if self.active_variant is not None else "themes", True)
+                if self.theme_index.cached:
+                    GLib.idle_add(self.set_mode, "simplified" if self.active_variant is not None else "themes", True)
+                else:
+                    # nothing is known about the installed themes yet
+                    self.choose_startup_mode = True
+
+            self.theme_index.update(self.on_theme_index_updated)
             return
 
         GLib.idle_add(self.set_mode, self.sidePage.stack.get_visible_child_name())
@@ -621,88 +1141,55 @@ class Module:
             self.gtk2_scrollbar_editor.set_size(widget.get_value())
 
     def on_file_changed(self, file, other, event, data):
+        for changed_file in (file, other):
+            if changed_file is not None:
+                self.theme_index.invalidate(changed_file.get_path())
+
         if self.refreshing:
             return
         self.refreshing = True
-        GLib.timeout_add_seconds(5, self.refresh_themes)
-        GLib.timeout_add_seconds(5, self.refresh_choosers)
+        GLib.timeout_add_seconds(5, self.update_theme_index)
+
+    def update_theme_index(self):
+        self.refreshing = False
+        self.theme_index.update(self.on_theme_index_updated)
+        return False
+
+    def on_theme_index_updated(self, changed):
+        if changed:
+            self.refresh_themes()
+            self.refresh_choosers()
+            self.reset_look_ui()
+
+        # the choosers asked for the previews of every theme which still needs one
+        self.theme_previews.prune()
+
+        if self.choose_startup_mode:
+            self.choose_startup_mode = False
+            self.set_mode("simplified" if self.active_variant is not None else "themes", True)
 
     def refresh_choosers(self):
         array = [(self.cursor_chooser, "cursors", self.cursor_themes, self._on_cursor_theme_selected),
                     (self.theme_chooser, "gtk-3.0", self.gtk_themes, self._on_gtk_theme_selected),
                     (self.cinnamon_chooser, "cinnamon", self.cinnamon_themes, self._on_cinnamon_theme_selected),
                     (self.icon_chooser, "icons", self.icon_theme_names, self._on_icon_theme_selected)]
+        self.chooser_generation += 1
         for element in array:
             chooser, path_suffix, themes, callback = element
             chooser.clear_menu()
-            chooser.set_sensitive(False)
-            chooser.progress = 0.0
             self.refresh_chooser(chooser, path_suffix, themes, callback)
-        self.refreshing = False
 
     def refresh_chooser(self, chooser, path_suffix, themes, callback):
-        inc = 1.0
-        if len(themes) > 0:
-            inc = 1.0 / len(themes)
-
+        # The choosers load their pictures in the background and show their own progress
         if path_suffix == 'icons':
-            cache_folder = GLib.get_user_cache_dir() + '/cs_themes/'
-            icon_cache_path = os.path.join(cache_folder, 'icons')
-
-            # Retrieve list of known themes/locations for faster loading (icon theme loading and lookup are very slow)
-            if os.path.exists(icon_cache_path):
-                read_path = icon_cache_path
-            else:
-                read_path = '/usr/share/cinnamon/cinnamon-settings/icons'
-
-            icon_paths = {}
-            with open(read_path, 'r') as cache_file:
-                for line in cache_file:
-                    theme_name, icon_path = line.strip().split(':')
-                    icon_paths[theme_name] = icon_path
-
-            dump = False
+            # Icon theme lookups are slow, so the ones which aren't cached are done in threads
+            # and their previews are filled in as they arrive.
+            self.icon_previews.load()
             for theme in themes:
-                theme_path = None
-
-                if theme in icon_paths:
-                    # loop through all possible locations until we find a match
-                    # (user folders should override system ones)
-                    for theme_folder in ICON_FOLDERS:
-                        possible_path = os.path.join(theme_folder, icon_paths[theme])
-                        if os.path.exists(possible_path):
-                            theme_path = possible_path
-                            break
-
-                if theme_path is None:
-                    icon_theme = Gtk.IconTheme()
-                    icon_theme.set_custom_theme(theme)
-                    folder = icon_theme.lookup_icon('folder', ICON_SIZE, Gtk.IconLookupFlags.FORCE_SVG)
-                    if folder:
-                        theme_path = folder.get_filename()
-
-                        # we need to get the relative path for storage
-                        for theme_folder in ICON_FOLDERS:
-                            if os.path.commonpath([theme_folder, theme_path]) == theme_folder:
-                                icon_paths[theme] = os.path.relpath(theme_path, start=theme_folder)
-                                break
-
-                    dump = True
-
-                if theme_path is None:
-                    continue
-
-                if os.path.exists(theme_path):
-                    chooser.add_picture(theme_path, callback, title=theme, id=theme)
-                GLib.timeout_add(5, self.increment_progress, (chooser, inc))
-
-            if dump:
-                if not os.path.exists(cache_folder):
-                    os.mkdir(cache_folder)
-
-                with open(icon_cache_path, 'w') as cache_file:
-                    for theme_name, icon_path in icon_paths.items():
-                        cache_file.write('%s:%s\n' % (theme_name, icon_path))
+                found, theme_path = self.icon_previews.lookup(theme)
+                menuitem = chooser.add_picture(theme_path, callback, title=theme, id=theme)
+                if not found:
+                    self.icon_previews.resolve(theme, self.on_preview_found, (chooser, menuitem, self.chooser_generation))
 
         else:
             if path_suffix == "cinnamon":
@@ -714,24 +1201,31 @@ class Module:
                 theme_name = theme[0]
                 theme_path = theme[1]
                 try:
-                    for path in ["%s/%s/%s/thumbnail.png" % (theme_path, theme_name, path_suffix),
-                                 "/usr/share/cinnamon/thumbnails/%s/%s.png" % (path_suffix, theme_name),
-                                 "/usr/share/cinnamon/thumbnails/%s/unknown.png" % path_suffix]:
-                        if os.path.exists(path):
-                            chooser.add_picture(path, callback, title=theme_name, id=theme_name)
+                    thumbnail = None
+                    for path in [self.theme_index.get_thumbnail(theme_path, theme_name, path_suffix),
+                                 "/usr/share/cinnamon/thumbnails/%s/%s.png" % (path_suffix, theme_name)]:
+                        if path is not None and os.path.exists(path):
+                            thumbnail = path
                             break
+
+                    if thumbnail is not None:
+                        chooser.add_picture(thumbnail, callback, title=theme_name, id=theme_name)
+                    else:
+                        menuitem = chooser.add_picture("/usr/share/cinnamon/thumbnails/%s/unknown.png" % path_suffix, callback, title=theme_name, id=theme_name)
+                        # Gtk themes can be rendered, this shows up once it's done
+                        if path_suffix == "gtk-3.0":
+                            self.theme_previews.request(theme_name, self.on_preview_found,
+                                                        (chooser, menuitem, self.chooser_generation))
                 except:
                     chooser.add_picture("/usr/share/cinnamon/thumbnails/%s/unknown.png" % path_suffix, callback, title=theme_name, id=theme_name)
-                GLib.timeout_add(5, self.increment_progress, (chooser, inc))
-        GLib.timeout_add(500, self.hide_progress, chooser)
-
-    def increment_progress(self, payload):
-        (chooser, inc) = payload
-        chooser.increment_loading_progress(inc)
 
-    def hide_progress(self, chooser):
-        chooser.set_sensitive(True)
-        chooser.reset_loading_progress()
+    def on_preview_found(self, theme, path, data):
+        (chooser, menuitem, generation) = data
+        if generation != self.chooser_generation or path is None:
+            return
+        chooser.set_item_picture(menuitem, path)
+        if chooser == self.theme_chooser and theme == self.settings.get_string("gtk-theme"):
+            chooser.set_picture_from_file(path)
 
     def _setParentRef(self, window):
         self.window = window
@@ -816,14 +1310,6 @@ class Module:
             print(detail)
         return True
 
-    def filter_func_gtk_dir(self, directory):
-        theme_dir = Path(directory)
-        for gtk3_dir in theme_dir.glob("gtk-3.*"):
-            # Skip gtk key themes
-            if os.path.exists(os.path.join(gtk3_dir, "gtk.css")):
-                return True
-        return False
-
     def update_cursor_theme_link(self, path, name):
         contents = "[icon theme]\nInherits=%s\n" % name
         self._set_cursor_theme_at(ICON_FOLDERS[0], contents)
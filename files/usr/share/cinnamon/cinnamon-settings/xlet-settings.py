@@ -14,7 +14,9 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin"))
 import gettext
 import json
 import argparse
+import copy
 import importlib.util
+import time
 import traceback
 from pathlib import Path
 
@@ -33,6 +35,9 @@ translations = {}
 
 proxy = None
 
+# Changes are passed on to Cinnamon at most this often per instance (ms)
+NOTIFY_INTERVAL = 50
+
 XLET_SETTINGS_WIDGETS = {
     "entry"             :   "JSONSettingsEntry",
     "textview"          :   "JSONSettingsTextView",
@@ -63,6 +68,90 @@ class XLETSettingsButton(Button):
     def on_activated(self):
         proxy.activateCallback('(sss)', self.xletCallback, self.uuid, self.instance_id)
 
+class SettingsNotifier(object):
+    """ tells Cinnamon about changed settings, coalescing quick successive changes """
+    def __init__(self, uuid, debug=False):
+        self.uuid = uuid
+        self.debug = debug
+
+        # instance id -> (handler, key, value) of the latest change not sent yet
+        self.pending = {}
+        self.in_flight = set()
+        self.timeout = None
+
+        self.changes = 0
+        self.sent = 0
+        self.deferred = 0
+        self.max_latency = 0
+
+    def queue(self, handler, key, value):
+        self.changes += 1
+        self.pending[handler.instance_id] = (handler, key, value)
+        if self.timeout is None:
+            self.timeout = GLib.timeout_add(NOTIFY_INTERVAL, self.on_timeout)
+
+    def on_timeout(self):
+        self.timeout = None
+
+        for instance_id in list(self.pending):
+            if instance_id in self.in_flight:
+                # Cinnamon hasn't caught up with the last one yet, this is
+                # sent once it has
+                self.deferred += 1
+                continue
+            self.send(*self.pending.pop(instance_id))
+
+        return False
+
+    def send(self, handler, key, value, sync=False):
+        # Cinnamon re-reads the whole file whenever it's told about a change,
+        # so one call covers every key that changed since the last one. The
+        # handler only queues a change once its write is done.
+        if proxy is None:
+            return
+
+        params = GLib.Variant("(ssss)", (self.uuid, handler.instance_id, key, json.dumps(value)))
+        self.sent += 1
+        if sync:
+            proxy.call_sync("updateSetting", params, Gio.DBusCallFlags.NONE, -1, None)
+            return
+
+        self.in_flight.add(handler.instance_id)
+        proxy.call("updateSetting", params, Gio.DBusCallFlags.NONE, -1, None,
+                   self.on_sent, (handler.instance_id, time.monotonic()))
+
+    def on_sent(self, proxy, result, data):
+        instance_id, start_time = data
+        self.in_flight.discard(instance_id)
+
+        try:
+            proxy.call_finish(result)
+        except GLib.Error as e:
+            print("Failed to update setting for %s: %s" % (self.uuid, e.message))
+
+        latency = time.monotonic() - start_time
+        self.max_latency = max(self.max_latency, latency)
+        if self.debug:
+            print("%s %s: reply after %.1fms, %d pending, %s" % (self.uuid, instance_id, latency * 1000, len(self.pending), self.get_stats()))
+
+        if instance_id in self.pending and self.timeout is None:
+            self.timeout = GLib.timeout_add(NOTIFY_INTERVAL, self.on_timeout)
+
+    def flush(self):
+        """ sends everything still pending right away """
+        if self.timeout is not None:
+            GLib.source_remove(self.timeout)
+            self.timeout = None
+
+        for instance_id in list(self.pending):
+            self.send(*self.pending.pop(instance_id), sync=True)
+
+        if self.debug:
+            print("%s: %s" % (self.uuid, self.get_stats()))
+
+    def get_stats(self):
+        return "%d changes, %d calls, %d deferred, max latency %.1fms" % (self.changes, self.sent, self.deferred, self.max_latency * 1000)
+
 def translate(uuid, string):
     #check for a translation for this xlet
     if uuid not in translations:
@@ -102,18 +191,25 @@ class MainWindow(object):
         self.selected_instance = None
         self.gsettings = Gio.Settings.new("org.cinnamon")
         self.custom_modules = {}
+        self.notifier = SettingsNotifier(self.uuid, args.debug)
+        # translated settings schemas, keyed by the schema's md5 so that
+        # all instances of an xlet share one
+        self.schema_cache = {}
+        self.plan_cache = {}
+        self.instance_files = {}
+        self.dir_monitors = []
 
         self.load_xlet_data()
         self.build_window()
         self.load_instances()
         self.window.show_all()
+        selected = self.instance_info[0]
         if self.instance_id and len(self.instance_info) > 1:
             for info in self.instance_info:
                 if info["id"] == self.instance_id:
-                    self.set_instance(info)
+                    selected = info
                     break
-        else:
-            self.set_instance(self.instance_info[0])
+        self.set_instance(selected)
         try:
             Gio.DBusProxy.new_for_bus(Gio.BusType.SESSION, Gio.DBusProxyFlags.NONE, None,
                                       "org.Cinnamon", "/org/Cinnamon", "org.Cinnamon", None, self._on_proxy_ready, None)
@@ -254,6 +350,8 @@ class MainWindow(object):
         except (KeyError, ValueError):
             multi_instance = False
 
+        enabled = self.gsettings.get_strv('enabled-%ss' % self.type) if multi_instance else []
+
         for item in dir_items:
             # ignore anything that isn't json
             if item[-5:] != ".json":
@@ -271,7 +369,6 @@ class MainWindow(object):
                     continue # multi-instance should have file names of the form [instance-id].json
 
                 instance_exists = False
-                enabled = self.gsettings.get_strv('enabled-%ss' % self.type)
                 for definition in enabled:
                     if self.uuid in definition and instance_id in definition.split(':'):
                         instance_exists = True
@@ -280,70 +377,172 @@ class MainWindow(object):
                 if not instance_exists:
                     continue
 
-            settings = JSONSettingsHandler(os.path.join(path if item in new_items else old_path, item), self.notify_dbus)
-            settings.instance_id = instance_id
+            # the settings and widgets of an instance are only loaded once
+            # it is shown, see load_instance()
             instance_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
             self.instance_stack.add_named(instance_box, instance_id)
 
-            info = {"settings": settings, "id": instance_id}
+            filepath = os.path.join(path if item in new_items else old_path, item)
+            info = {"id": instance_id, "path": filepath, "box": instance_box}
             self.instance_info.append(info)
+            self.instance_files[filepath] = info
 
-            settings_map = settings.get_settings()
-            first_key = next(iter(settings_map.values()))
-
-            try:
-                for setting in settings_map:
-                    if setting == "__md5__":
-                        continue
-                    for key in settings_map[setting]:
-                        if key in ("description", "tooltip", "units"):
-                            try:
-                                settings_map[setting][key] = translate(self.uuid, settings_map[setting][key])
-                            except (KeyError, ValueError):
-                                traceback.print_exc()
-                        elif key in "options":
-                            new_opt_data = collections.OrderedDict()
-                            opt_data = settings_map[setting][key]
-                            for option in opt_data:
-                                if opt_data[option] == "custom":
-                                    continue
-                                new_opt_data[translate(self.uuid, option)] = opt_data[option]
-                            settings_map[setting][key] = new_opt_data
-                        elif key in "columns":
-                            columns_data = settings_map[setting][key]
-                            for column in columns_data:
-                                column["title"] = translate(self.uuid, column["title"])
-            finally:
-                # if a layout is not explicitly defined, generate the settings
-                # widgets based on the order they occur
-                if first_key["type"] == "layout":
-                    self.build_with_layout(settings_map, info, instance_box, first_key)
-                else:
-                    self.build_from_order(settings_map, info, instance_box, first_key)
-
-                if self.selected_instance is None:
-                    self.selected_instance = info
-                    if "stack" in info:
-                        self.stack_switcher.set_stack(info["stack"])
+            if self.selected_instance is None:
+                self.selected_instance = info
 
             instances += 1
 
+        # one monitor per config directory instead of one per instance file
+        for directory in sorted(set(os.path.dirname(filepath) for filepath in self.instance_files)):
+            monitor = Gio.File.new_for_path(directory).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect("changed", self.on_config_dir_changed)
+            self.dir_monitors.append(monitor)
+
         if instances < 2:
             self.prev_button.set_no_show_all(True)
             self.next_button.set_no_show_all(True)
 
-    def build_with_layout(self, settings_map, info, box, first_key):
-        layout = first_key
+    def load_instance(self, info):
+        settings = JSONSettingsHandler(info["path"], self.notify_dbus, monitor=False)
+        settings.instance_id = info["id"]
+        info["settings"] = settings
+
+        instance_box = info["box"]
+        settings_map = self.get_schema(settings)
+        self.build_from_plan(self.get_layout_plan(settings_map), info, instance_box)
+
+        instance_box.show_all()
+
+    def get_schema(self, settings):
+        md5 = settings.settings.get("__md5__")
+        if md5 is not None and md5 in self.schema_cache:
+            return self.schema_cache[md5]
+
+        # the handler's own copy is written back to disk, so translate a copy
+        settings_map = copy.deepcopy(settings.settings)
+
+        try:
+            for setting in settings_map:
+                if setting == "__md5__":
+                    continue
+                for key in settings_map[setting]:
+                    if key in ("description", "tooltip", "units"):
+                        try:
+                            settings_map[setting][key] = translate(self.uuid, settings_map[setting][key])
+                        except (KeyError, ValueError):
+                            traceback.print_exc()
+                    elif key in "options":
+                        new_opt_data = collections.OrderedDict()
+                        opt_data = settings_map[setting][key]
+                        for option in opt_data:
+                            if opt_data[option] == "custom":
+                                continue
+                            new_opt_data[translate(self.uuid, option)] = opt_data[option]
+                        settings_map[setting][key] = new_opt_data
+                    elif key in "columns":
+                        columns_data = settings_map[setting][key]
+                        for column in columns_data:
+                            column["title"] = translate(self.uuid, column["title"])
+        except Exception:
+            # build what we can, but don't share a half translated schema
+            traceback.print_exc()
+            return settings_map
+
+        if md5 is not None:
+            self.schema_cache[md5] = settings_map
+        return settings_map
+
+    def on_config_dir_changed(self, monitor, file, other_file, event_type):
+        for changed_file in (file, other_file):
+            if changed_file is None:
+                continue
+            info = self.instance_files.get(changed_file.get_path())
+            if info is not None and "settings" in info:
+                info["settings"].check_settings()
+
+    def get_layout_plan(self, settings_map):
+        """ works out the pages, sections and rows to build for a schema. Plans are
+            cached along with the schema, so instances only need to create the widgets """
+        md5 = settings_map.get("__md5__")
+        if md5 is not None and md5 in self.plan_cache:
+            return self.plan_cache[md5]
+
+        # if a layout is not explicitly defined, generate the settings
+        # widgets based on the order they occur
+        first_key = next(iter(settings_map.values()))
+        if first_key["type"] == "layout":
+            plan = self.plan_with_layout(settings_map, first_key)
+        else:
+            plan = self.plan_from_order(settings_map, first_key)
 
-        page_stack = SettingsStack()
-        box.pack_start(page_stack, True, True, 0)
-        self.stack_switcher.show()
-        info["stack"] = page_stack
+        if md5 is not None:
+            self.plan_cache[md5] = plan
+        return plan
 
+    def plan_with_layout(self, settings_map, layout):
+        pages = []
         for page_key in layout["pages"]:
             page_def = layout[page_key]
+            page = {"key": page_key, "title": translate(self.uuid, page_def["title"]), "custom": None, "sections": []}
+            pages.append(page)
+
             if page_def['type'] == 'custom':
-                page = self.create_custom_widget(page_def, info['settings'])
+                page["custom"] = page_def
+                continue
+
+            for section_key in page_def["sections"]:
+                section_def = layout[section_key]
+                section = self.plan_section(translate(self.uuid, section_def["title"]), section_def)
+                page["sections"].append(section)
+                for key in section_def["keys"]:
+                    self.plan_row(section, key, settings_map[key])
+
+        return {"stack": True, "pages": pages}
+
+    def plan_from_order(self, settings_map, first_key):
+        page = {"key": None, "title": None, "custom": None, "sections": []}
+
+        # if the first key is not of type 'header' or type 'section' we need to make a new section
+        if first_key["type"] not in ("header", "section"):
+            page["sections"].append(self.plan_section(_("Settings for %s") % self.uuid, {}))
+
+        for key, item in settings_map.items():
+            if key == "__md5__":
+                continue
+            if "type" in item:
+                if item["type"] in ("header", "section"):
+                    page["sections"].append(self.plan_section(translate(self.uuid, item["description"]), item))
+                    continue
+
+                self.plan_row(page["sections"][-1], key, item)
+
+        return {"stack": False, "pages": [page]}
+
+    def plan_section(self, title, definition):
+        return {"title": title, "dependency": definition.get("dependency"), "rows": []}
+
+    def plan_row(self, section, key, item):
+        settings_type = item["type"]
+        if settings_type in ("button", "label", "custom"):
+            widget_class = None
+        elif settings_type in XLET_SETTINGS_WIDGETS:
+            widget_class = globals()[XLET_SETTINGS_WIDGETS[settings_type]]
+        else:
+            return
+
+        section["rows"].append((key, item, widget_class))
+
+    def build_from_plan(self, plan, info, box):
+        page_stack = None
+        if plan["stack"]:
+            page_stack = SettingsStack()
+            box.pack_start(page_stack, True, True, 0)
+            self.stack_switcher.show()
+            info["stack"] = page_stack
+
+        for page_plan in plan["pages"]:
+            if page_plan["custom"] is not None:
+                page = self.create_custom_widget(page_plan["custom"], info['settings'])
                 if page is None:
                     continue
                 elif not isinstance(page, SettingsPage):
@@ -351,30 +550,16 @@ class MainWindow(object):
                     continue
             else:
                 page = SettingsPage()
-                for section_key in page_def["sections"]:
-                    section_def = layout[section_key]
-                    if 'dependency' in section_def:
-                        revealer = JSONSettingsRevealer(info['settings'], section_def['dependency'])
-                        section = page.add_reveal_section(translate(self.uuid, section_def["title"]), revealer=revealer)
+                for section_plan in page_plan["sections"]:
+                    if section_plan["dependency"] is not None:
+                        revealer = JSONSettingsRevealer(info['settings'], section_plan['dependency'])
+                        section = page.add_reveal_section(section_plan["title"], revealer=revealer)
                     else:
-                        section = page.add_section(translate(self.uuid, section_def["title"]))
-                    for key in section_def["keys"]:
-                        item = settings_map[key]
-                        settings_type = item["type"]
-                        if settings_type == "button":
-                            widget = XLETSettingsButton(item, self.uuid, info["id"])
-                        elif settings_type == "label":
-                            widget = Text(translate(self.uuid, item["description"]))
-                        elif settings_type == 'custom':
-                            widget = self.create_custom_widget(item, key, info['settings'])
-                            if widget is None:
-                                continue
-                            elif not isinstance(widget, SettingsWidget):
-                                print('widget is not of type SettingsWidget')
-                                continue
-                        elif settings_type in XLET_SETTINGS_WIDGETS:
-                            widget = globals()[XLET_SETTINGS_WIDGETS[settings_type]](key, info["settings"], item)
-                        else:
+                        section = page.add_section(section_plan["title"])
+
+                    for key, item, widget_class in section_plan["rows"]:
+                        widget = self.create_row_widget(key, item, widget_class, info)
+                        if widget is None:
                             continue
 
                         if 'dependency' in item:
@@ -382,50 +567,27 @@ class MainWindow(object):
                             section.add_reveal_row(widget, revealer=revealer)
                         else:
                             section.add_row(widget)
-            page_stack.add_titled(page, page_key, translate(self.uuid, page_def["title"]))
 
-    def build_from_order(self, settings_map, info, box, first_key):
-        page = SettingsPage()
-        box.pack_start(page, True, True, 0)
+            if page_stack is not None:
+                page_stack.add_titled(page, page_plan["key"], page_plan["title"])
+            else:
+                box.pack_start(page, True, True, 0)
 
-        # if the first key is not of type 'header' or type 'section' we need to make a new section
-        if first_key["type"] not in ("header", "section"):
-            section = page.add_section(_("Settings for %s") % self.uuid)
+    def create_row_widget(self, key, item, widget_class, info):
+        if widget_class is not None:
+            return widget_class(key, info["settings"], item)
 
-        for key, item in settings_map.items():
-            if key == "__md5__":
-                continue
-            if "type" in item:
-                settings_type = item["type"]
-                if settings_type in ("header", "section"):
-                    if 'dependency' in item:
-                        revealer = JSONSettingsRevealer(info['settings'], item['dependency'])
-                        section = page.add_reveal_section(translate(self.uuid, item["description"]), revealer=revealer)
-                    else:
-                        section = page.add_section(translate(self.uuid, item["description"]))
-                    continue
-
-                if settings_type == "button":
-                    widget = XLETSettingsButton(item, self.uuid, info["id"])
-                elif settings_type == "label":
-                    widget = Text(translate(self.uuid, item["description"]))
-                elif settings_type == 'custom':
-                    widget = self.create_custom_widget(item, key, info['settings'])
-                    if widget is None:
-                        continue
-                    elif not isinstance(widget, SettingsWidget):
-                        print('widget is not of type SettingsWidget')
-                        continue
-                elif settings_type in XLET_SETTINGS_WIDGETS:
-                    widget = globals()[XLET_SETTINGS_WIDGETS[settings_type]](key, info["settings"], item)
-                else:
-                    continue
+        settings_type = item["type"]
+        if settings_type == "button":
+            return XLETSettingsButton(item, self.uuid, info["id"])
+        elif settings_type == "label":
+            return Text(translate(self.uuid, item["description"]))
 
-                if 'dependency' in item:
-                    revealer = JSONSettingsRevealer(info['settings'], item['dependency'])
-                    section.add_reveal_row(widget, revealer=revealer)
-                else:
-                    section.add_row(widget)
+        widget = self.create_custom_widget(item, key, info['settings'])
+        if widget is not None and not isinstance(widget, SettingsWidget):
+            print('widget is not of type SettingsWidget')
+            return None
+        return widget
 
     def create_custom_widget(self, info, *args):
         file_name = info['file']
@@ -447,9 +609,12 @@ class MainWindow(object):
         return getattr(self.custom_modules[file_name], widget_name)(info, *args)
 
     def notify_dbus(self, handler, key, value):
-        proxy.updateSetting('(ssss)', self.uuid, handler.instance_id, key, json.dumps(value))
+        self.notifier.queue(handler, key, value)
 
     def set_instance(self, info):
+        if "settings" not in info:
+            self.load_instance(info)
+
         self.instance_stack.set_visible_child_name(info["id"])
         if "stack" in info:
             self.stack_switcher.set_stack(info["stack"])
@@ -530,6 +695,12 @@ class MainWindow(object):
             proxy.ReloadXlet('(ss)', self.uuid, self.type.upper())
 
     def quit(self, *args):
+        # writing out the last changes queues their notifications
+        for info in self.instance_info:
+            if "settings" in info:
+                info["settings"].flush()
+        self.notifier.flush()
+
         if proxy:
             proxy.highlightXlet('(ssb)', self.uuid, self.selected_instance["id"], False)
 
@@ -547,6 +718,7 @@ if __name__ == "__main__":
     parser.add_argument("uuid", type=str, help="The UUID of the xlet")
     parser.add_argument("-i", "--id", type=int, default=None, metavar="instance_id", help="If a UUID is provided, this is the instance id.")
     parser.add_argument("-t", "--tab", type=int, default=None, metavar="tab_number", help="Tab index to open.")
+    parser.add_argument("-d", "--debug", action="store_true", help="Print statistics about the setting updates sent to Cinnamon.")
 
     args = parser.parse_args()
 